@@ -0,0 +1,60 @@
+# accounts.py
+import bisect
+import hashlib
+from typing import Dict, List, Optional
+
+from dispatcher import SendDispatcher
+
+
+class Account:
+    """A user session together with the dispatcher that paces its sends"""
+
+    __slots__ = ('name', 'client', 'dispatcher')
+
+    def __init__(self, name: str, client, dispatcher: SendDispatcher):
+        self.name = name
+        self.client = client
+        self.dispatcher = dispatcher
+
+
+class AccountRouter:
+    """Assigns every destination chat to the account that sends to it.
+
+    Destinations are spread over the accounts with a consistent hash ring, so
+    adding or removing an account only moves the destinations that hashed to
+    it. ``pins`` maps a destination id to an account name and overrides the
+    ring, e.g. to keep a destination on the account that is a member of it.
+    """
+
+    def __init__(self, accounts: List[Account], pins: Optional[Dict[str, str]] = None, replicas: int = 64):
+        if not accounts:
+            raise ValueError("At least one account is required")
+        self.accounts = accounts
+        by_name = {account.name: account for account in accounts}
+        self.pins = {int(dest_id): by_name[name] for dest_id, name in (pins or {}).items() if name in by_name}
+        self._ring = sorted(
+            (self._hash(f"{account.name}#{replica}"), index)
+            for index, account in enumerate(accounts)
+            for replica in range(replicas)
+        )
+        self._points = [point for point, _ in self._ring]
+        self._assigned: Dict[int, Account] = {}
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    @property
+    def primary(self) -> Account:
+        """The account that listens to source chats and serves admin commands"""
+        return self.accounts[0]
+
+    def account_for(self, dest_id: int) -> Account:
+        account = self._assigned.get(dest_id)
+        if account is None:
+            account = self.pins.get(dest_id)
+            if account is None:
+                position = bisect.bisect(self._points, self._hash(str(dest_id))) % len(self._ring)
+                account = self.accounts[self._ring[position][1]]
+            self._assigned[dest_id] = account
+        return account
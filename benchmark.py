@@ -0,0 +1,401 @@
+# benchmark.py
+# Offline benchmarks: drives the forwarder with a fake Telegram client, no network needed.
+#
+#   python benchmark.py                       run every scenario
+#   python benchmark.py media_heavy flood_waits
+#   python benchmark.py --events 500 --json
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Tuple
+
+from telethon import events
+from telethon.errors import FloodWaitError
+from telethon.tl.types import InputFile, MessageMediaPhoto, Photo, PhotoSize, User
+
+# Every scenario starts from these settings
+DEFAULTS = {
+    'sources': 1,                 # Source chats
+    'dests_per_source': 1,        # Destinations of every source
+    'events': 2000,               # Source events to emit
+    'rate': 1000.0,               # Source events per second
+    'edit_ratio': 0.0,            # Share of events that edit an earlier message
+    'delete_ratio': 0.0,          # Share of events that delete an earlier message
+    'media_ratio': 0.0,           # Share of new messages with a photo
+    'media_size': 256 * 1024,     # Bytes per photo
+    'transfer_speed': 50 * 1024 * 1024,  # Simulated download/upload speed, bytes per second
+    'send_latency': 0.005,        # Seconds every Telegram request takes
+    'flood_ratio': 0.0,           # Share of sends answered with a FloodWait
+    'flood_seconds': 1,           # Length of those FloodWaits
+    'replacements': 10,           # Entries in word_replacements
+    'blacklist': 10,              # Entries in blacklist_words
+    'words_per_message': 30
+}
+
+SCENARIOS = {
+    'baseline': {},
+    'many_rules': {'sources': 50, 'dests_per_source': 10},
+    'large_replacements': {'replacements': 5000, 'blacklist': 1000, 'dests_per_source': 3},
+    'media_heavy': {'events': 500, 'rate': 200.0, 'media_ratio': 0.8, 'media_size': 2 * 1024 * 1024,
+                    'dests_per_source': 3},
+    'edits_and_deletes': {'edit_ratio': 0.3, 'delete_ratio': 0.1, 'dests_per_source': 3},
+    'flood_waits': {'flood_ratio': 0.01, 'dests_per_source': 5}
+}
+
+# Every message carries "[source/id]" so a delivered copy can be traced back to it
+TOKEN = re.compile(r'\[(-?\d+)/(\d+)\]')
+
+
+class Recorder:
+    """What the fake clients delivered, and when"""
+
+    def __init__(self):
+        self.emitted: Dict[Tuple[int, int], float] = {}
+        self.latencies: Dict[str, List[float]] = {'message': [], 'edit': []}
+        self.requests = 0
+        self.floods = 0
+        self.first_delivery: Optional[float] = None
+        self.last_activity = time.monotonic()
+
+    def delivered(self, kind: str, text: Optional[str]):
+        now = time.monotonic()
+        match = TOKEN.search(text or '')
+        if match:
+            emitted = self.emitted.get((int(match.group(1)), int(match.group(2))))
+            if emitted is not None:
+                self.latencies[kind].append(now - emitted)
+        if self.first_delivery is None:
+            self.first_delivery = now
+        self.last_activity = now
+
+
+class FakeMessage:
+    """The parts of a Telethon message the forwarder reads"""
+
+    def __init__(self, chat_id: int, msg_id: int, text: Optional[str], media=None,
+                 settings: Optional[dict] = None):
+        self.chat_id = chat_id
+        self.id = msg_id
+        self.text = text
+        self.message = text
+        self.media = media
+        self.grouped_id = None
+        self.entities = None
+        self.settings = settings
+
+    async def download_media(self, file=None):
+        size = self.settings['media_size']
+        await asyncio.sleep(size / self.settings['transfer_speed'])
+        data = bytes(size)
+        if file is bytes:
+            return data
+        with open(file, 'wb') as f:
+            f.write(data)
+        return file
+
+
+def fake_photo(size: int) -> MessageMediaPhoto:
+    return MessageMediaPhoto(photo=Photo(
+        id=random.getrandbits(63), access_hash=0, file_reference=b'', date=None,
+        sizes=[PhotoSize(type='x', w=1280, h=720, size=size)], dc_id=1
+    ))
+
+
+class FakeClient:
+    """Stands in for TelegramClient.
+
+    Registered event handlers are called by ``emit``. Every request takes
+    ``send_latency`` seconds, transfers run at ``transfer_speed`` and a
+    ``flood_ratio`` share of sends fail with a FloodWait.
+    """
+
+    def __init__(self, name: str, settings: dict, recorder: Recorder):
+        self.settings = settings
+        self.recorder = recorder
+        self.rng = random.Random(name)
+        self.handlers = []
+        self._ids = itertools.count(1)
+
+    def add_event_handler(self, callback, builder):
+        self.handlers.append((callback, builder))
+
+    def remove_event_handler(self, callback):
+        self.handlers = [(c, b) for c, b in self.handlers if c != callback]
+
+    async def emit(self, builder_type, event):
+        for callback, builder in self.handlers:
+            if type(builder) is builder_type:
+                await callback(event)
+
+    async def _request(self, flood: bool = True):
+        self.recorder.requests += 1
+        await asyncio.sleep(self.settings['send_latency'])
+        if flood and self.rng.random() < self.settings['flood_ratio']:
+            self.recorder.floods += 1
+            raise FloodWaitError(request=None, capture=self.settings['flood_seconds'])
+
+    async def send_message(self, entity, message, **kwargs):
+        await self._request()
+        text = message if isinstance(message, str) else message.text
+        self.recorder.delivered('message', text)
+        return FakeMessage(entity, next(self._ids), text)
+
+    async def send_file(self, entity, file, caption=None, **kwargs):
+        await self._request()
+        if isinstance(file, list):
+            for item in caption or []:
+                self.recorder.delivered('message', item)
+            return [FakeMessage(entity, next(self._ids), item) for item in caption or [''] * len(file)]
+        self.recorder.delivered('message', caption)
+        return FakeMessage(entity, next(self._ids), caption)
+
+    async def edit_message(self, entity, message, text=None, **kwargs):
+        await self._request()
+        self.recorder.delivered('edit', text)
+
+    async def delete_messages(self, entity, message_ids, **kwargs):
+        await self._request()
+        self.recorder.last_activity = time.monotonic()
+
+    async def get_entity(self, entity):
+        await self._request(flood=False)
+        return User(id=abs(entity))
+
+    async def get_permissions(self, entity, user=None):
+        await self._request(flood=False)
+        return SimpleNamespace(is_admin=True)
+
+    async def upload_file(self, file, file_name=None, **kwargs):
+        size = len(file) if isinstance(file, bytes) else os.path.getsize(file)
+        await asyncio.sleep(size / self.settings['transfer_speed'])
+        return InputFile(id=random.getrandbits(63), parts=1, name=file_name or 'file', md5_checksum='')
+
+    async def __call__(self, request):
+        # Only UploadMediaRequest is sent directly
+        await self._request(flood=False)
+        return fake_photo(self.settings['media_size'])
+
+
+def scenario_config(settings: dict) -> dict:
+    """A config.json with the scenario's rules, word lists and no rate limits"""
+    rules = {
+        str(source_id(s)): [str(dest_id(s, d)) for d in range(settings['dests_per_source'])]
+        for s in range(settings['sources'])
+    }
+    return {
+        'forwarding_rules': rules,
+        'word_replacements': {f"word{i}": f"term{i}" for i in range(settings['replacements'])},
+        'blacklist_words': [f"banned{i}" for i in range(settings['blacklist'])],
+        'approved_words': [],
+        'admins': [],
+        'dispatch_settings': {
+            'max_concurrent_sends': 64,
+            'bulk_concurrent_sends': 16,
+            'max_concurrent_transfers': 8,
+            'max_flood_wait': 3600,
+            'max_pending_per_destination': 1000000,
+            'rate_limits': {
+                'global_per_second': 1000000, 'global_burst': 1000000,
+                'per_chat_per_second': 1000000, 'per_chat_burst': 1000000
+            }
+        }
+    }
+
+
+def source_id(index: int) -> int:
+    return -1000000000000 - index
+
+
+def dest_id(source_index: int, index: int) -> int:
+    return 1000000 + source_index * 1000 + index
+
+
+def message_text(rng: random.Random, settings: dict, source: int, msg_id: int) -> str:
+    words = [
+        f"word{rng.randrange(settings['replacements'])}" if settings['replacements'] and rng.random() < 0.2
+        else f"filler{rng.randrange(1000)}"
+        for _ in range(settings['words_per_message'])
+    ]
+    # About one message in fifty is blocked
+    if settings['blacklist'] and rng.random() < 0.02:
+        words.append(f"banned{rng.randrange(settings['blacklist'])}")
+    return f"[{source}/{msg_id}] " + ' '.join(words)
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def run_scenario(settings: dict) -> dict:
+    from forwarder import Forwarder
+
+    recorder = Recorder()
+
+    class OfflineForwarder(Forwarder):
+        def create_client(self, session_name: str):
+            return FakeClient(session_name, settings, recorder)
+
+    with open('config.json', 'w', encoding='utf-8') as f:
+        json.dump(scenario_config(settings), f)
+    forwarder = OfflineForwarder()
+    if forwarder.message_map.store is not None:
+        asyncio.create_task(forwarder.message_map.store.run())
+    forwarder.start_consumers()
+    forwarder.event_handlers = (forwarder.queue_message, forwarder.queue_edit, forwarder.queue_delete)
+    forwarder.register_handlers()
+    client = forwarder.client
+
+    rng = random.Random(0)
+    sources = [source_id(s) for s in range(settings['sources'])]
+    next_ids = {source: itertools.count(1) for source in sources}
+    sent: Dict[int, List[int]] = {source: [] for source in sources}
+    started = time.monotonic()
+    for index in range(settings['events']):
+        delay = started + index / settings['rate'] - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        source = sources[index % len(sources)]
+        roll = rng.random()
+
+        if roll < settings['delete_ratio'] and sent[source]:
+            msg_id = sent[source].pop(rng.randrange(len(sent[source])))
+            await client.emit(events.MessageDeleted, SimpleNamespace(chat_id=source, deleted_ids=[msg_id]))
+        elif roll < settings['delete_ratio'] + settings['edit_ratio'] and sent[source]:
+            msg_id = rng.choice(sent[source])
+            message = FakeMessage(source, msg_id, message_text(rng, settings, source, msg_id), settings=settings)
+            recorder.emitted[(source, msg_id)] = time.monotonic()
+            await client.emit(events.MessageEdited, SimpleNamespace(chat_id=source, message=message))
+        else:
+            msg_id = next(next_ids[source])
+            media = fake_photo(settings['media_size']) if rng.random() < settings['media_ratio'] else None
+            message = FakeMessage(source, msg_id, message_text(rng, settings, source, msg_id), media, settings)
+            recorder.emitted[(source, msg_id)] = time.monotonic()
+            sent[source].append(msg_id)
+            await client.emit(events.NewMessage, SimpleNamespace(chat_id=source, message=message))
+        recorder.last_activity = time.monotonic()
+    emitted = time.monotonic()
+
+    # Done once nothing is queued or being sent, and the message map has caught up
+    while len(forwarder.inbound) or forwarder.sending or time.monotonic() - recorder.last_activity < 0.25:
+        await asyncio.sleep(0.05)
+    elapsed = recorder.last_activity - started
+
+    # Cost of the text rules alone, per message
+    rule = next(iter(forwarder.rules.routes.values()))[0]
+    texts = [message_text(rng, settings, sources[0], i) for i in range(1000)]
+    timer = time.perf_counter()
+    for text in texts:
+        if forwarder.should_forward_message(text, rule):
+            forwarder.process_message_text(text, rule)
+    text_seconds = (time.perf_counter() - timer) / len(texts)
+
+    copies = len(recorder.latencies['message'])
+    blocked = sum(count for count in forwarder.rule_counters.counts.get('blocked', {}).values())
+    forwarder.message_map.close()
+    forwarder.dialogs.close()
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        'events': settings['events'],
+        'emit_seconds': emitted - started,
+        'elapsed': elapsed,
+        'copies': copies,
+        'edits': len(recorder.latencies['edit']),
+        'blocked': blocked,
+        'shed': forwarder.inbound.dropped,
+        'floods': recorder.floods,
+        'requests': recorder.requests,
+        'throughput': copies / elapsed if elapsed > 0 else 0.0,
+        'p50': percentile(recorder.latencies['message'], 0.5),
+        'p99': percentile(recorder.latencies['message'], 0.99),
+        'edit_p50': percentile(recorder.latencies['edit'], 0.5),
+        'text_us': text_seconds * 1000000,
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        'max_rss_mb': max_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    }
+
+
+def run_in_process(name: str, overrides: dict) -> dict:
+    """Run one scenario in a fresh process and directory, so memory and databases start clean"""
+    with tempfile.TemporaryDirectory(prefix='forwarder-bench-') as directory:
+        result = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--run', name, '--overrides', json.dumps(overrides)],
+            cwd=directory, capture_output=True, text=True
+        )
+    if result.returncode != 0:
+        raise RuntimeError(f"Scenario {name} failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def format_ms(seconds: Optional[float]) -> str:
+    return '-' if seconds is None else f"{seconds * 1000:.1f}"
+
+
+def print_table(results: Dict[str, dict]):
+    columns = [
+        ('scenario', 20, lambda name, r: name),
+        ('events', 7, lambda name, r: r['events']),
+        ('copies', 7, lambda name, r: r['copies']),
+        ('blocked', 8, lambda name, r: r['blocked']),
+        ('shed', 5, lambda name, r: r['shed']),
+        ('floods', 7, lambda name, r: r['floods']),
+        ('time s', 7, lambda name, r: f"{r['elapsed']:.2f}"),
+        ('copies/s', 9, lambda name, r: f"{r['throughput']:.0f}"),
+        ('p50 ms', 8, lambda name, r: format_ms(r['p50'])),
+        ('p99 ms', 8, lambda name, r: format_ms(r['p99'])),
+        ('edit p50', 9, lambda name, r: format_ms(r['edit_p50'])),
+        ('text µs', 8, lambda name, r: f"{r['text_us']:.1f}"),
+        ('RSS MB', 7, lambda name, r: f"{r['max_rss_mb']:.0f}")
+    ]
+    print(' '.join(f"{title:>{width}}" if i else f"{title:<{width}}" for i, (title, width, _) in enumerate(columns)))
+    for name, result in results.items():
+        print(' '.join(
+            f"{str(value(name, result)):>{width}}" if i else f"{str(value(name, result)):<{width}}"
+            for i, (_, width, value) in enumerate(columns)
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the forwarder offline with a fake Telegram client")
+    parser.add_argument('scenarios', nargs='*', help=f"scenarios to run (default: all of {', '.join(SCENARIOS)})")
+    parser.add_argument('--events', type=int, help="source events per scenario")
+    parser.add_argument('--rate', type=float, help="source events per second")
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    parser.add_argument('--overrides', default='{}', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        # Child process: run a single scenario here and print its result
+        logging.disable(logging.INFO)
+        settings = {**DEFAULTS, **SCENARIOS[args.run], **json.loads(args.overrides)}
+        print(json.dumps(asyncio.run(run_scenario(settings))))
+        return
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    overrides = {key: value for key, value in (('events', args.events), ('rate', args.rate)) if value is not None}
+    results = {name: run_in_process(name, overrides) for name in args.scenarios or SCENARIOS}
+    if args.json:
+        print(json.dumps(results, indent=4))
+    else:
+        print_table(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,18 @@
 # bot_ui.py
 import asyncio
+import io
 from telethon import TelegramClient, events, Button
+from telethon.errors import MessageNotModifiedError
 from telethon.tl.custom import Message
 import json
 import logging
 import os
-import socket
 from dotenv import load_dotenv
-from typing import Optional, Dict
+from typing import Dict
+from ipc import IPCClient
+from chat_index import ChatIndex
+from metrics import format_stats
+from config_store import export_rules, import_mutations
 
 # Load environment variables
 load_dotenv()
@@ -27,49 +32,92 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+CHAT_PAGE_SIZE = 8  # Chats shown per page of the chat picker
+
 class BotUI:
     def __init__(self):
         self.bot = TelegramClient("bot_ui", API_ID, API_HASH)
         self.user_states: Dict[int, dict] = {}
+        # The forwarder owns config.json; this copy follows its change notifications
         self.config = self.load_config()
+        self.config_version = -1
+        # Chat list from the forwarder's dialog cache, kept current by pushed updates
+        self.chats: Dict[str, dict] = {}
+        self.chat_index = ChatIndex({})
         self.lock = asyncio.Lock()
+        self.forwarder = IPCClient(
+            'localhost', 65432,
+            on_event=self.handle_forwarder_event,
+            on_connect=self.watch_config
+        )
 
     def load_config(self) -> dict:
+        """Read config.json once at startup, until the forwarder sends the live config"""
+        default_config = {
+            "forwarding_rules": {},
+            "word_replacements": {},
+            "blacklist_words": [],
+            "approved_words": [],
+            "admins": [os.getenv('ADMIN_ID', '')],
+            "forward_media_settings": {}
+        }
         try:
             with open("config.json", "r", encoding='utf-8') as f:
                 config = json.load(f)
-
-                config.setdefault('forward_media_settings', {})
-                return config
         except FileNotFoundError:
-            default_config = {
-                "forwarding_rules": {},
-                "word_replacements": {},
-                "blacklist_words": [],
-                "approved_words": [],
-                "admins": [os.getenv('ADMIN_ID', '')],
-                "available_chats": {},
-                "forward_media_settings": {}
-            }
-            self.save_config(default_config)
             return default_config
+        for key, value in default_config.items():
+            config.setdefault(key, value)
+        return config
+
+    def apply_config(self, snapshot: dict):
+        self.config = snapshot['config']
+        self.config_version = snapshot['version']
 
-    def save_config(self, config: Optional[dict] = None):
-        if config is None:
-            config = self.config
+    async def watch_config(self):
+        """Subscribe to config and chat list changes; runs again whenever the connection is re-established"""
         try:
-            if 'forward_media_settings' not in config:
-                config['forward_media_settings'] = {}
-            with open("config.json", "w", encoding='utf-8') as f:
-                json.dump(config, f, indent=4, ensure_ascii=False)
+            self.apply_config(json.loads(await self.send_command_to_forwarder("watch_config")))
+            self.set_chats(json.loads(await self.send_command_to_forwarder("get_chats")))
         except Exception as e:
-            logger.error(f"Error saving config: {e}")
-            raise
+            logger.error(f"Error subscribing to config changes: {e}")
+
+    def handle_forwarder_event(self, event: dict):
+        if event.get('event') == 'config':
+            self.apply_config(event)
+        elif event.get('event') == 'chats':
+            self.set_chats(event['chats'])
+
+    def set_chats(self, chats: Dict[str, dict]):
+        self.chats = chats
+        self.chat_index = ChatIndex(chats)
+
+    async def refresh_config(self):
+        self.apply_config(json.loads(await self.send_command_to_forwarder("get_config")))
+
+    async def mutate_config(self, mutation: dict) -> bool:
+        """Have the forwarder apply a config change; returns whether anything changed"""
+        return await self.apply_config_command(f"mutate:{json.dumps(mutation)}")
+
+    async def mutate_config_batch(self, mutations: list) -> int:
+        """Apply several config changes in one transaction; returns how many changed anything"""
+        return await self.apply_config_command(f"batch:{json.dumps(mutations)}")
+
+    async def apply_config_command(self, command: str):
+        response = await self.send_command_to_forwarder(command)
+        if response.startswith("Error"):
+            raise RuntimeError(response)
+        result = json.loads(response)
+        # Usually the pushed change has already arrived; if not, fetch it so the next screen is current
+        if self.config_version < result['version']:
+            await self.refresh_config()
+        return result['changed']
 
     async def start(self):
         """Start the bot and set up event handlers"""
         try:
             await self.bot.start(bot_token=BOT_TOKEN)
+            asyncio.create_task(self.forwarder.run())
             self.bot.add_event_handler(self.handle_start, events.NewMessage(pattern="/start"))
             self.bot.add_event_handler(self.handle_callback, events.CallbackQuery())
             self.bot.add_event_handler(self.handle_message, events.NewMessage())
@@ -89,7 +137,8 @@ class BotUI:
             [Button.inline("➕ Add Rule", b"add_rule"), Button.inline("📋 List Rules", b"list_rules")],
             [Button.inline("🔄 Word Replace", b"word_replace"), Button.inline("⛔ Blacklist", b"blacklist")],
             [Button.inline("✅ Approved Words", b"approved"), Button.inline("❌ Stop All", b"stop_all")],
-            [Button.inline("🔍 Fetch Available Chats", b"fetch_chats")]
+            [Button.inline("🔍 Fetch Available Chats", b"fetch_chats"), Button.inline("📊 Stats", b"stats")],
+            [Button.inline("📤 Export Rules", b"export_rules"), Button.inline("📥 Import Rules", b"import_rules")]
         ]
         await event.respond(
             "🤖 **Message Forwarder Control Panel**\n\n"
@@ -119,8 +168,18 @@ class BotUI:
                 await self.handle_stop_all(event)
             elif data == "fetch_chats":
                 await self.handle_fetch_chats(event)
+            elif data == "export_rules":
+                await self.handle_export_rules(event)
+            elif data == "import_rules":
+                await self.handle_import_rules(event)
+            elif data == "stats":
+                await self.handle_stats(event)
             elif data == "main_menu":
                 await self.handle_start(event)
+            elif data.startswith("pick_page:"):
+                await self.handle_picker_page(event, data)
+            elif data == "pick_clear":
+                await self.handle_picker_clear(event)
             elif data.startswith("select_source_"):
                 await self.handle_source_selection(event, data)
             elif data.startswith("select_dest_"):
@@ -156,27 +215,18 @@ class BotUI:
     #region Forwarding Rule Management
     async def handle_add_rule(self, event):
         """Handle adding new forwarding rule"""
-        if not self.config['available_chats']:
+        if not self.chats:
             await event.edit("Please fetch available chats first!", buttons=[[Button.inline("🔍 Fetch Chats", b"fetch_chats")]])
             return
 
-        buttons = []
-        for chat_id, info in self.config['available_chats'].items():
-            buttons.append([Button.inline(f"📌 {info['title']} ({info['type']})", f"select_source_{chat_id}".encode())])
-        buttons.append([Button.inline("◀️ Back to Menu", b"main_menu")])
-        await event.edit("Select source chat:", buttons=buttons)
+        self.open_chat_picker(event.sender_id, "source")
+        await self.show_chat_page(event, event.sender_id)
 
     async def handle_source_selection(self, event, data):
         """Handle source chat selection"""
         source_id = data.replace("select_source_", "")
-        self.user_states[event.sender_id] = {"state": "selecting_dest", "source": source_id}
-        
-        buttons = []
-        for chat_id, info in self.config['available_chats'].items():
-            if chat_id != source_id:
-                buttons.append([Button.inline(f"📌 {info['title']} ({info['type']})", f"select_dest_{chat_id}".encode())])
-        buttons.append([Button.inline("◀️ Back", b"add_rule")])
-        await event.edit("Select destination chat:", buttons=buttons)
+        self.open_chat_picker(event.sender_id, "dest", source=source_id)
+        await self.show_chat_page(event, event.sender_id)
 
     async def handle_destination_selection(self, event, data):
         """Handle destination chat selection"""
@@ -190,8 +240,8 @@ class BotUI:
                 "destination": dest_id
             })
 
-            source_info = self.config['available_chats'].get(source_id, {"title": "Unknown"})
-            dest_info = self.config['available_chats'].get(dest_id, {"title": "Unknown"})
+            source_info = self.chats.get(source_id, {"title": "Unknown"})
+            dest_info = self.chats.get(dest_id, {"title": "Unknown"})
             
             # Create properly encoded callback data for the media preference buttons
             yes_callback = f"media:yes:{source_id}:{dest_id}"
@@ -229,22 +279,7 @@ class BotUI:
             forward_media = (choice == "yes")
             
             async with self.lock:
-
-                self.config.setdefault('forward_media_settings', {})
-
-                if source_id not in self.config['forwarding_rules']:
-                    self.config['forwarding_rules'][source_id] = []
-                
-                # Add destination if not present
-                if dest_id not in self.config['forwarding_rules'][source_id]:
-                    self.config['forwarding_rules'][source_id].append(dest_id)
-                
-                # Set media preference with proper key format
-                media_key = f"{source_id}:{dest_id}"
-                self.config['forward_media_settings'][media_key] = forward_media
-                self.save_config()
-
-                # Start forwarding with correct media setting
+                # The forwarder stores the rule and its media setting
                 try:
                     await self.start_forwarding(source_id, dest_id, forward_media)
                 except Exception as e:
@@ -273,9 +308,9 @@ class BotUI:
             buttons = []
             
             for source_id, destinations in self.config['forwarding_rules'].items():
-                source_info = self.config['available_chats'].get(source_id, {"title": "Unknown"})
+                source_info = self.chats.get(source_id, {"title": "Unknown"})
                 for dest_id in destinations:
-                    dest_info = self.config['available_chats'].get(dest_id, {"title": "Unknown"})
+                    dest_info = self.chats.get(dest_id, {"title": "Unknown"})
                     
                     # Correctly get media setting
                     media_key = f"{source_id}:{dest_id}"
@@ -315,21 +350,9 @@ class BotUI:
             
             async with self.lock:
                 if source_id in self.config['forwarding_rules'] and dest_id in self.config['forwarding_rules'][source_id]:
-                    # Stop forwarding first
+                    # The forwarder removes the rule and its media setting
                     await self.stop_forwarding(source_id, dest_id)
-                    
-                    # Remove from forwarding rules
-                    self.config['forwarding_rules'][source_id].remove(dest_id)
-                    if not self.config['forwarding_rules'][source_id]:
-                        del self.config['forwarding_rules'][source_id]
-                    
-                    # Remove media setting
-                    media_key = f"{source_id}:{dest_id}"
-                    if media_key in self.config['forward_media_settings']:
-                        del self.config['forward_media_settings'][media_key]
-                    
-                    self.save_config()
-                    
+
                     await event.edit(
                         "✅ Rule deleted successfully!",
                         buttons=[[Button.inline("◀️ Back to Rules", b"list_rules")]]
@@ -390,9 +413,7 @@ class BotUI:
         """Remove selected replacement"""
         old_word = data.replace("rm_replace_", "")
         async with self.lock:
-            if old_word in self.config['word_replacements']:
-                del self.config['word_replacements'][old_word]
-                self.save_config()
+            await self.mutate_config({'op': 'remove_replacement', 'old': old_word})
         await event.answer(f"Removed: {old_word}", alert=True)
         await self.handle_word_replace(event)
     #endregion
@@ -437,9 +458,7 @@ class BotUI:
         """Remove selected blacklist word"""
         word = data.replace("rm_black_", "")
         async with self.lock:
-            if word in self.config['blacklist_words']:
-                self.config['blacklist_words'].remove(word)
-                self.save_config()
+            await self.mutate_config({'op': 'remove_word', 'list_name': 'blacklist_words', 'word': word})
         await event.answer(f"Removed: {word}", alert=True)
         await self.handle_blacklist(event)
     #endregion
@@ -484,56 +503,85 @@ class BotUI:
         """Remove selected approved word"""
         word = data.replace("rm_approved_", "")
         async with self.lock:
-            if word in self.config['approved_words']:
-                self.config['approved_words'].remove(word)
-                self.save_config()
+            if await self.mutate_config({'op': 'remove_word', 'list_name': 'approved_words', 'word': word}):
                 await event.answer(f"Removed: {word}", alert=True)
                 await self.handle_approved_words(event)
                 #endregion
 
+    #region Rules Import/Export
+    async def handle_export_rules(self, event):
+        """Send the rules and word filters as a JSON file"""
+        data = json.dumps(export_rules(self.config), indent=4, ensure_ascii=False).encode('utf-8')
+        file = io.BytesIO(data)
+        file.name = "rules.json"
+        await event.answer()
+        await self.bot.send_file(event.chat_id, file, caption="📤 Forwarding rules and word filters")
+
+    async def handle_import_rules(self, event):
+        """Ask for a rules file to merge into the config"""
+        self.user_states[event.sender_id] = {"state": "awaiting_rules_file"}
+        await event.edit(
+            "Send a rules JSON file (as exported) to import.\n"
+            "Rules, replacements and words are added to the current ones.\n"
+            "Type /cancel to abort",
+            buttons=[[Button.inline("◀️ Back to Menu", b"main_menu")]]
+        )
+
+    async def handle_rules_file_input(self, event, user_id):
+        """Apply an uploaded rules file through one batch command"""
+        if not event.message.file or event.message.file.size > 1024 * 1024:
+            await event.respond("Please send a JSON file of at most 1 MB.")
+            return
+
+        try:
+            rules = json.loads(await event.message.download_media(file=bytes))
+            mutations = import_mutations(rules)
+        except (ValueError, AttributeError) as e:
+            await event.respond(f"❌ Invalid rules file: {e}")
+            return
+
+        async with self.lock:
+            changed = await self.mutate_config_batch(mutations)
+        del self.user_states[user_id]
+        await event.respond(
+            f"✅ Imported {len(mutations)} entries, {changed} changed the config",
+            buttons=[[Button.inline("◀️ Back to Menu", b"main_menu")]]
+        )
+    #endregion
+
+    async def handle_stats(self, event):
+        """Show how long each stage of forwarding takes, per rule"""
+        response = await self.send_command_to_forwarder("stats")
+        if response.startswith("Error"):
+            text = f"❌ Failed to get stats: {response}"
+        else:
+            text = "**📊 Stage Latency per Rule**\n\n" + format_stats(json.loads(response))
+            if len(text) > 4096:
+                text = text[:text.rindex('\n', 0, 4000)] + "\n\n…"
+        try:
+            await event.edit(text, buttons=[
+                [Button.inline("🔄 Refresh", b"stats")],
+                [Button.inline("◀️ Back to Menu", b"main_menu")]
+            ])
+        except MessageNotModifiedError:
+            await event.answer("No new data")
+
     async def handle_fetch_chats(self, event):
         """Handle fetching available chats"""
         await event.answer("🔄 Fetching available chats...")
         try:
             response = await self.send_command_to_forwarder("fetch_chats")
             if response.startswith("Success"):
-                self.config = self.load_config()
-                chats = self.config.get('available_chats', {})
-
-                if not chats:
+                # Answered from the forwarder's cache; a refresh continues in the background
+                if not self.chats:
                     await event.edit(
-                        "No chats found. Please check your permissions.",
+                        "No chats cached yet. They are being fetched, please try again in a moment.",
                         buttons=[[Button.inline("◀️ Back to Menu", b"main_menu")]]
                     )
                     return
 
-                text = "**📋 Available Chats:**\n\n"
-                for chat_id, info in chats.items():
-                    text += f"📌 **{info['title']}**\n"
-                    text += f"🆔 `{chat_id}`\n"
-                    text += f"📱 Type: {info['type'].title()}\n"
-                    if info.get('members_count'):
-                        text += f"👥 Members: {info['members_count']}\n"
-                    if info.get('username'):
-                        text += f"🔗 @{info['username']}\n"
-                    text += "\n"
-
-                # Handle long messages
-                if len(text) > 4096:
-                    chunks = [text[i:i+4096] for i in range(0, len(text), 4096)]
-                    for i, chunk in enumerate(chunks):
-                        if i == len(chunks) - 1:
-                            await event.edit(
-                                chunk,
-                                buttons=[[Button.inline("◀️ Back to Menu", b"main_menu")]]
-                            )
-                        else:
-                            await event.respond(chunk)
-                else:
-                    await event.edit(
-                        text,
-                        buttons=[[Button.inline("◀️ Back to Menu", b"main_menu")]]
-                    )
+                self.open_chat_picker(event.sender_id, "browse")
+                await self.show_chat_page(event, event.sender_id)
             else:
                 await event.edit(
                     f"❌ Failed to fetch chats: {response}",
@@ -546,6 +594,111 @@ class BotUI:
                 buttons=[[Button.inline("◀️ Back to Menu", b"main_menu")]]
             )
 
+    #region Chat Picker
+    def open_chat_picker(self, user_id: int, purpose: str, source: str = None):
+        """Start paging through the chat list to pick a source or destination, or just to browse it"""
+        self.user_states[user_id] = {
+            "state": "picking_chat",
+            "purpose": purpose,
+            "source": source,
+            "query": "",
+            "page": 0,
+            "results": None,
+            "index": None
+        }
+
+    async def show_chat_page(self, event, user_id: int):
+        """Render the current page of a user's chat picker"""
+        picker = self.user_states.get(user_id)
+        if not picker or picker["state"] != "picking_chat":
+            await event.edit("This chat list has expired.", buttons=[[Button.inline("◀️ Back to Menu", b"main_menu")]])
+            return
+
+        # Search again only when the query or the chat list changed
+        if picker["index"] is not self.chat_index:
+            results = self.chat_index.search(picker["query"])
+            if picker["source"] is not None:
+                results = [chat_id for chat_id in results if chat_id != picker["source"]]
+            picker.update(results=results, index=self.chat_index)
+        results = picker["results"]
+        pages = max(1, -(-len(results) // CHAT_PAGE_SIZE))
+        page = picker["page"] = min(picker["page"], pages - 1)
+        page_chats = [
+            (chat_id, self.chats[chat_id])
+            for chat_id in results[page * CHAT_PAGE_SIZE:(page + 1) * CHAT_PAGE_SIZE]
+            if chat_id in self.chats
+        ]
+
+        purpose = picker["purpose"]
+        text = {
+            "source": "Select source chat:",
+            "dest": "Select destination chat:",
+            "browse": "**📋 Available Chats:**"
+        }[purpose]
+        if picker["query"]:
+            text += f"\n🔍 {len(results)} matching \"{picker['query']}\""
+        else:
+            text += f"\n{len(results)} chats"
+        text += "\nSend a message to search by title, username or ID.\n\n"
+
+        buttons = []
+        if purpose == "browse":
+            for chat_id, info in page_chats:
+                text += f"📌 **{info['title']}**\n"
+                text += f"🆔 `{chat_id}`\n"
+                text += f"📱 Type: {info['type'].title()}\n"
+                if info.get('username'):
+                    text += f"🔗 @{info['username']}\n"
+                text += "\n"
+        else:
+            prefix = "select_source_" if purpose == "source" else "select_dest_"
+            for chat_id, info in page_chats:
+                buttons.append([Button.inline(f"📌 {info['title']} ({info['type']})", f"{prefix}{chat_id}".encode())])
+
+        nav = []
+        if page > 0:
+            nav.append(Button.inline("◀️ Prev", f"pick_page:{page - 1}".encode()))
+        if pages > 1:
+            nav.append(Button.inline(f"{page + 1}/{pages}", f"pick_page:{page}".encode()))
+        if page < pages - 1:
+            nav.append(Button.inline("Next ▶️", f"pick_page:{page + 1}".encode()))
+        if nav:
+            buttons.append(nav)
+        if picker["query"]:
+            buttons.append([Button.inline("✖️ Clear Search", b"pick_clear")])
+        if purpose == "dest":
+            buttons.append([Button.inline("◀️ Back", b"add_rule")])
+        else:
+            buttons.append([Button.inline("◀️ Back to Menu", b"main_menu")])
+
+        if isinstance(event, events.CallbackQuery.Event):
+            await event.edit(text, buttons=buttons)
+        else:
+            await event.respond(text, buttons=buttons)
+
+    async def handle_picker_page(self, event, data):
+        """Move to another page of the chat picker"""
+        picker = self.user_states.get(event.sender_id)
+        if picker and picker["state"] == "picking_chat":
+            picker["page"] = int(data.split(':')[1])
+        await self.show_chat_page(event, event.sender_id)
+
+    async def handle_picker_clear(self, event):
+        """Show the whole chat list again"""
+        picker = self.user_states.get(event.sender_id)
+        if picker and picker["state"] == "picking_chat":
+            picker.update(query="", page=0, index=None)
+        await self.show_chat_page(event, event.sender_id)
+
+    async def handle_chat_search_input(self, event, user_id):
+        """Narrow the chat picker down to the chats matching the message"""
+        query = event.message.text.strip()
+        if not query or query.startswith('/'):
+            return
+        self.user_states[user_id].update(query=query, page=0, index=None)
+        await self.show_chat_page(event, user_id)
+    #endregion
+
     async def handle_word_replace(self, event):
         """Handle word replacement settings"""
         replacements = self.config['word_replacements']
@@ -589,6 +742,10 @@ class BotUI:
                 await self.handle_blacklist_input(event, user_id)
             elif state == "awaiting_approved":
                 await self.handle_approved_input(event, user_id)
+            elif state == "awaiting_rules_file":
+                await self.handle_rules_file_input(event, user_id)
+            elif state == "picking_chat":
+                await self.handle_chat_search_input(event, user_id)
         except Exception as e:
             logger.error(f"Error handling message state {state}: {e}")
             await event.respond(
@@ -596,28 +753,15 @@ class BotUI:
                 buttons=[[Button.inline("◀️ Back to Menu", b"main_menu")]]
             )
 
-    async def send_command_to_forwarder(self, command: str, retries=3):
+    async def send_command_to_forwarder(self, command: str) -> str:
         """Send command to forwarder service"""
-        for attempt in range(retries):
-            try:
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                    s.connect(('localhost', 65432))
-                    s.settimeout(10)  # 10 second timeout
-                    s.sendall(command.encode('utf-8'))
-                    response = s.recv(1024).decode('utf-8')
-                    logger.info(f"Response from forwarder: {response}")
-                    return response
-            except socket.timeout:
-                logger.error("Timeout while communicating with forwarder")
-                raise RuntimeError("Forwarder communication timeout")
-            except ConnectionRefusedError:
-                logger.error("Forwarder service is not running")
-                raise RuntimeError("Forwarder service is not running")
-            except Exception as e:
-                logger.error(f"Failed to communicate with forwarder: {e}")
-                if attempt == retries - 1:
-                    raise
-                await asyncio.sleep(1)
+        try:
+            response = await self.forwarder.request(command)
+            logger.info(f"Response from forwarder: {response[:200]}")
+            return response
+        except Exception as e:
+            logger.error(f"Failed to communicate with forwarder: {e}")
+            raise
 
     async def start_forwarding(self, source_id: str, dest_id: str, forward_media: bool):
         """Start forwarding messages between chats"""
@@ -650,8 +794,6 @@ class BotUI:
             async with self.lock:
                 response = await self.send_command_to_forwarder("stop_all")
                 if response.startswith("Success"):
-                    self.config['forwarding_rules'] = {}
-                    self.save_config()
                     await event.edit(
                         "✅ All forwarding rules have been stopped.",
                         buttons=[[Button.inline("◀️ Back to Menu", b"main_menu")]]
@@ -688,8 +830,7 @@ class BotUI:
 
             old_word = self.user_states[user_id]["old_word"]
             async with self.lock:
-                self.config['word_replacements'][old_word] = new_word
-                self.save_config()
+                await self.mutate_config({'op': 'set_replacement', 'old': old_word, 'new': new_word})
             del self.user_states[user_id]
             await event.respond(
                 f"✅ Added replacement: '{old_word}' → '{new_word}'",
@@ -711,9 +852,7 @@ class BotUI:
                 return
 
             async with self.lock:
-                self.config['blacklist_words'].extend(words)
-                self.config['blacklist_words'] = list(set(self.config['blacklist_words']))
-                self.save_config()
+                await self.mutate_config({'op': 'add_words', 'list_name': 'blacklist_words', 'words': words})
 
             del self.user_states[user_id]
             await event.respond(
@@ -736,9 +875,7 @@ class BotUI:
                 return
 
             async with self.lock:
-                self.config['approved_words'].extend(words)
-                self.config['approved_words'] = list(set(self.config['approved_words']))
-                self.save_config()
+                await self.mutate_config({'op': 'add_words', 'list_name': 'approved_words', 'words': words})
 
             del self.user_states[user_id]
             await event.respond(
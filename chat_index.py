@@ -0,0 +1,41 @@
+# chat_index.py
+from bisect import bisect_left
+from typing import Dict, List
+
+
+class ChatIndex:
+    """The chat list prepared for searching from the bot UI.
+
+    Titles are case-folded and sorted once when the chat list changes, so
+    prefix matches are found by binary search. Substring matches against the
+    title, username and id come after them, in title order.
+    """
+
+    def __init__(self, chats: Dict[str, dict]):
+        entries = sorted((info['title'].casefold(), chat_id) for chat_id, info in chats.items())
+        self._titles = [title for title, _ in entries]
+        self._ids = [chat_id for _, chat_id in entries]
+        self._keys = [
+            f"{title}\n@{(chats[chat_id].get('username') or '').casefold()}\n{chat_id}"
+            for title, chat_id in entries
+        ]
+
+    def __len__(self):
+        return len(self._ids)
+
+    def search(self, query: str) -> List[str]:
+        """Ids of the chats matching ``query``, title prefix matches first; all chats if it is empty"""
+        query = query.strip().casefold()
+        if not query:
+            return list(self._ids)
+
+        start = bisect_left(self._titles, query)
+        end = start
+        while end < len(self._titles) and self._titles[end].startswith(query):
+            end += 1
+        others = [
+            chat_id
+            for index, (key, chat_id) in enumerate(zip(self._keys, self._ids))
+            if (index < start or index >= end) and query in key
+        ]
+        return self._ids[start:end] + others
@@ -0,0 +1,296 @@
+# config_store.py
+import asyncio
+import copy
+import json
+import logging
+import os
+import tempfile
+from typing import Callable, List, Optional
+
+from dispatcher import LANES
+
+logger = logging.getLogger(__name__)
+
+WORD_LISTS = ('blacklist_words', 'approved_words')
+# How a rule sends messages: rebuilt, or re-sent by reference
+MODES = ('copy', 'native')
+# The parts of the config that make up an exported rules file
+RULE_SECTIONS = (
+    'forwarding_rules', 'forward_media_settings', 'forward_mode_settings', 'forward_priority_settings',
+    'word_replacements', 'blacklist_words', 'approved_words'
+)
+
+
+class ConfigService:
+    """The config, owned by a single process and changed through small mutations.
+
+    Every mutation bumps ``version`` and is passed to the listeners right away,
+    while the file is rewritten in the background: serialised on the event
+    loop, written to a temporary file by an executor thread and renamed over
+    ``config.json``, so readers never see a half-written file. Mutations that
+    arrive while a save is running are coalesced into one more save.
+    """
+
+    def __init__(self, path: str = 'config.json', defaults: Optional[dict] = None):
+        self.path = path
+        self.defaults = defaults or {}
+        self.config = self._load()
+        self.version = 0
+        self.listeners: List[Callable[[int], None]] = []
+        self._dirty = False
+        self._saving: Optional[asyncio.Future] = None
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+        except FileNotFoundError:
+            config = {}
+        for key, value in self.defaults.items():
+            config.setdefault(key, copy.deepcopy(value))
+        return config
+
+    def subscribe(self, listener: Callable[[int], None]):
+        """Call ``listener(version)`` after every change"""
+        self.listeners.append(listener)
+
+    def _changed(self):
+        self.version += 1
+        for listener in self.listeners:
+            try:
+                listener(self.version)
+            except Exception as e:
+                logger.error(f"Error in config listener: {e}")
+
+    def _apply(self, mutation: dict) -> bool:
+        op = mutation.get('op')
+        apply = getattr(self, f"_op_{op}", None)
+        if apply is None:
+            raise ValueError(f"Unknown config operation: {op}")
+        args = {key: value for key, value in mutation.items() if key != 'op'}
+        return apply(**args)
+
+    def mutate(self, mutation: dict) -> bool:
+        """Apply one change and schedule a save; returns whether anything changed.
+
+        Like ``mutate_many``, a change that fails leaves the config as it was.
+        """
+        return self.mutate_many([mutation]) > 0
+
+    def mutate_many(self, mutations: List[dict]) -> int:
+        """Apply several changes as one transaction.
+
+        The changes are made to a copy that replaces the config only if all of
+        them succeed, so a failing mutation leaves nothing half-applied.
+        Listeners are notified and the file is saved once for the whole batch.
+        Returns how many of the mutations changed anything.
+        """
+        original = self.config
+        self.config = copy.deepcopy(original)
+        try:
+            changed = sum(1 for mutation in mutations if self._apply(mutation))
+        except Exception:
+            self.config = original
+            raise
+        if changed:
+            self._changed()
+            self._schedule_save()
+        return changed
+
+    def reload(self):
+        """Pick up changes made to the file by hand"""
+        self.config = self._load()
+        self._changed()
+
+    def replace(self, config: dict, version: int):
+        """Adopt a snapshot published by the owning process, without saving it"""
+        self.config = config
+        self.version = version - 1
+        self._changed()
+
+    def snapshot(self) -> dict:
+        return {'version': self.version, 'config': self.config}
+
+    def _schedule_save(self):
+        self._dirty = True
+        if self._saving is None or self._saving.done():
+            self._saving = asyncio.ensure_future(self._save())
+
+    async def _save(self):
+        loop = asyncio.get_running_loop()
+        while self._dirty:
+            self._dirty = False
+            data = json.dumps(self.config, indent=4, ensure_ascii=False)
+            try:
+                await loop.run_in_executor(None, self._write, data)
+            except Exception as e:
+                logger.error(f"Error saving config: {e}")
+
+    def _write(self, data: str):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.config-', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    async def flush(self):
+        """Wait until every change so far has been written"""
+        if self._saving is not None:
+            await self._saving
+
+    # Mutations; each returns whether it changed the config
+
+    def _op_add_rule(self, source: str, dest: str, media: bool = True, mode: Optional[str] = None,
+                     priority: Optional[str] = None) -> bool:
+        # Checked before anything is changed, so a bad rule is not left half-added
+        if priority is not None and priority not in LANES:
+            raise ValueError(f"Unknown priority lane: {priority}")
+        if mode is not None and mode not in MODES:
+            raise ValueError(f"Unknown forwarding mode: {mode}")
+        dests = self.config['forwarding_rules'].setdefault(source, [])
+        if dest not in dests:
+            dests.append(dest)
+        rule_key = f"{source}:{dest}"
+        self.config['forward_media_settings'][rule_key] = media
+        if mode is not None:
+            self.config['forward_mode_settings'][rule_key] = mode
+        if priority is not None:
+            self.config['forward_priority_settings'][rule_key] = priority
+        return True
+
+    def _op_remove_rule(self, source: str, dest: str) -> bool:
+        dests = self.config['forwarding_rules'].get(source)
+        if not dests or dest not in dests:
+            return False
+        dests.remove(dest)
+        if not dests:
+            del self.config['forwarding_rules'][source]
+        rule_key = f"{source}:{dest}"
+        self.config['forward_media_settings'].pop(rule_key, None)
+        self.config['forward_mode_settings'].pop(rule_key, None)
+        self.config['forward_priority_settings'].pop(rule_key, None)
+        return True
+
+    def _op_clear_rules(self) -> bool:
+        self.config['forwarding_rules'] = {}
+        self.config['forward_media_settings'] = {}
+        self.config['forward_mode_settings'] = {}
+        self.config['forward_priority_settings'] = {}
+        return True
+
+    def _word_list(self, name: str) -> list:
+        if name not in WORD_LISTS:
+            raise ValueError(f"Unknown word list: {name}")
+        return self.config[name]
+
+    def _op_add_words(self, list_name: str, words: List[str]) -> bool:
+        current = self._word_list(list_name)
+        added = [word for word in dict.fromkeys(words) if word and word not in current]
+        current.extend(added)
+        return bool(added)
+
+    def _op_remove_word(self, list_name: str, word: str) -> bool:
+        current = self._word_list(list_name)
+        if word not in current:
+            return False
+        current.remove(word)
+        return True
+
+    def _op_set_replacement(self, old: str, new: str) -> bool:
+        if not old:
+            raise ValueError("Replacement needs a word to replace")
+        self.config['word_replacements'][old] = new
+        return True
+
+    def _op_remove_replacement(self, old: str) -> bool:
+        return self.config['word_replacements'].pop(old, None) is not None
+
+
+def export_rules(config: dict) -> dict:
+    """The rules and filters of a config, as written to a rules file"""
+    return {section: config[section] for section in RULE_SECTIONS if section in config}
+
+
+def _is_chat_id(value) -> bool:
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        return False
+    try:
+        int(value)
+    except ValueError:
+        return False
+    return True
+
+
+def _is_rule_key(key: str) -> bool:
+    source, _, dest = key.partition(':')
+    return _is_chat_id(source) and _is_chat_id(dest)
+
+
+def _check_mapping(rules: dict, section: str, valid_key: Callable[[str], bool], key_expected: str,
+                   valid_value: Callable[[object], bool], value_expected: str):
+    mapping = rules.get(section, {})
+    if not isinstance(mapping, dict):
+        raise ValueError(f"{section} must be a mapping")
+    for key, value in mapping.items():
+        if not valid_key(key):
+            raise ValueError(f"{section}: {key!r} is not {key_expected}")
+        if not valid_value(value):
+            raise ValueError(f"{section}[{key!r}]: {value!r} is not {value_expected}")
+
+
+def validate_rules(rules: dict):
+    """Check the shape of a rules file, raising ValueError with what is wrong"""
+    if not isinstance(rules, dict):
+        raise ValueError("A rules file must be a JSON object")
+    unknown = set(rules) - set(RULE_SECTIONS)
+    if unknown:
+        raise ValueError(f"Unknown sections in rules file: {', '.join(sorted(unknown))}")
+
+    _check_mapping(rules, 'forwarding_rules', _is_chat_id, "a chat id",
+                   lambda dests: isinstance(dests, list) and all(_is_chat_id(dest) for dest in dests),
+                   "a list of chat ids")
+    rule_key = "a source:destination pair of chat ids"
+    _check_mapping(rules, 'forward_media_settings', _is_rule_key, rule_key,
+                   lambda media: isinstance(media, bool), "true or false")
+    _check_mapping(rules, 'forward_mode_settings', _is_rule_key, rule_key,
+                   lambda mode: mode in MODES, f"one of {', '.join(MODES)}")
+    _check_mapping(rules, 'forward_priority_settings', _is_rule_key, rule_key,
+                   lambda lane: lane in LANES, f"one of {', '.join(LANES)}")
+    _check_mapping(rules, 'word_replacements', lambda old: bool(old), "a word",
+                   lambda new: isinstance(new, str), "text")
+    for list_name in WORD_LISTS:
+        words = rules.get(list_name, [])
+        if not isinstance(words, list) or not all(isinstance(word, str) for word in words):
+            raise ValueError(f"{list_name} must be a list of words")
+
+
+def import_mutations(rules: dict) -> List[dict]:
+    """Turn a rules file into mutations that merge it into the current config"""
+    validate_rules(rules)
+
+    media_settings = rules.get('forward_media_settings', {})
+    mode_settings = rules.get('forward_mode_settings', {})
+    priority_settings = rules.get('forward_priority_settings', {})
+    mutations = []
+    for source, dests in rules.get('forwarding_rules', {}).items():
+        for dest in dests:
+            rule_key = f"{source}:{dest}"
+            mutation = {'op': 'add_rule', 'source': str(source), 'dest': str(dest),
+                        'media': media_settings.get(rule_key, True)}
+            if rule_key in mode_settings:
+                mutation['mode'] = mode_settings[rule_key]
+            if rule_key in priority_settings:
+                mutation['priority'] = priority_settings[rule_key]
+            mutations.append(mutation)
+    for old, new in rules.get('word_replacements', {}).items():
+        mutations.append({'op': 'set_replacement', 'old': old, 'new': new})
+    for list_name in WORD_LISTS:
+        if rules.get(list_name):
+            mutations.append({'op': 'add_words', 'list_name': list_name, 'words': rules[list_name]})
+    return mutations
@@ -0,0 +1,214 @@
+# dialogs.py
+import asyncio
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from telethon.tl.types import Channel, Chat, User
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 100  # Dialogs per GetDialogs request
+
+
+def describe_entity(entity) -> Optional[Tuple[str, dict]]:
+    """The chat id, formatted as in the forwarding rules, and listing of a dialog's entity"""
+    entity_id = getattr(entity, 'id', None)
+    if entity_id is None:
+        return None
+
+    # Handle different entity types
+    if isinstance(entity, Channel):
+        if entity.megagroup:
+            chat_id = f"-100{entity_id}"  # Supergroup
+            chat_type = "supergroup"
+        else:
+            chat_id = str(entity_id)  # Channel
+            chat_type = "channel"
+    elif isinstance(entity, Chat):
+        chat_id = str(entity_id)  # Basic group (already negative)
+        chat_type = "group"
+    elif isinstance(entity, User):
+        chat_id = str(entity_id)  # Private chat
+        chat_type = "user"
+    else:
+        return None
+
+    # Get title safely
+    title = getattr(entity, 'title', None) or \
+            f"{getattr(entity, 'first_name', '')} {getattr(entity, 'last_name', '')}".strip()
+
+    return chat_id, {
+        'title': title,
+        'type': chat_type,
+        'username': getattr(entity, 'username', None),
+        'access_hash': getattr(entity, 'access_hash', None)
+    }
+
+
+class DialogCache:
+    """The account's dialogs, cached in SQLite and refreshed incrementally.
+
+    A sync walks the dialog list from the most recently active chat and stops
+    at the first one without messages since the previous sync, reading at
+    most ``pages_per_sync`` pages. Chats that change without new messages
+    (renames, new usernames) and chats that were left are caught by a sweep
+    that reads ``sweep_pages`` further pages per sync, continuing from where
+    the previous sync stopped. Once a sweep reaches the end of the list,
+    chats it did not see are dropped.
+
+    Only chats that changed, or that have not been marked as seen in the
+    current sweep yet, are written back.
+    """
+
+    def __init__(self, path: str = 'dialogs.db', pages_per_sync: int = 5, sweep_pages: int = 2):
+        self.path = path
+        self.pages_per_sync = pages_per_sync
+        self.sweep_pages = sweep_pages
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='dialog-cache')
+        self._lock = asyncio.Lock()
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS dialogs ('
+            ' chat_id TEXT PRIMARY KEY,'
+            ' title TEXT NOT NULL,'
+            ' type TEXT NOT NULL,'
+            ' username TEXT,'
+            ' access_hash INTEGER,'
+            ' seen_at REAL NOT NULL'
+            ') WITHOUT ROWID'
+        )
+        self.conn.execute('CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value REAL) WITHOUT ROWID')
+        self.conn.commit()
+
+        self.chats: Dict[str, dict] = {}
+        self.seen_at: Dict[str, float] = {}
+        for chat_id, title, chat_type, username, access_hash, seen_at in self.conn.execute(
+            'SELECT chat_id, title, type, username, access_hash, seen_at FROM dialogs'
+        ):
+            self.chats[chat_id] = {'title': title, 'type': chat_type, 'username': username, 'access_hash': access_hash}
+            self.seen_at[chat_id] = seen_at
+        self.state: Dict[str, float] = dict(self.conn.execute('SELECT key, value FROM sync_state'))
+
+    def seed(self, chats: Dict[str, dict]):
+        """Fill an empty cache from a chat list fetched the old way"""
+        if self.chats or not chats:
+            return
+        now = time.time()
+        self._write([(chat_id, info, now) for chat_id, info in chats.items()], [], {})
+        self.chats.update(chats)
+        self.seen_at.update((chat_id, now) for chat_id in chats)
+
+    async def sync(self, client) -> int:
+        """Refresh changed dialogs; returns how many chats were added, changed or dropped"""
+        async with self._lock:
+            now = time.time()
+            rows: List[Tuple[str, dict, float]] = []
+            state = {}
+            changed = 0
+            # A chat needs its seen_at refreshed once per sweep, so it is not dropped at the end
+            sweep_started = now if self.state.get('sweep_offset') is None else self.state.get('sweep_started', now)
+
+            def visit(dialog):
+                nonlocal changed
+                described = describe_entity(dialog.entity)
+                if described is None:
+                    return
+                chat_id, info = described
+                if self.chats.get(chat_id) != info:
+                    self.chats[chat_id] = info
+                    changed += 1
+                elif self.seen_at.get(chat_id, 0.0) >= sweep_started:
+                    return
+                rows.append((chat_id, info, now))
+
+            try:
+                # Recently active dialogs, down to the newest one already seen
+                high_water = self.state.get('high_water', 0.0)
+                newest = high_water
+                async for dialog in client.iter_dialogs(limit=self.pages_per_sync * PAGE_SIZE):
+                    date = dialog.date.timestamp() if dialog.date else 0.0
+                    if date <= high_water and not dialog.pinned:
+                        break
+                    visit(dialog)
+                    newest = max(newest, date)
+                state['high_water'] = newest
+
+                # The next stretch of the sweep through the whole list
+                offset = self.state.get('sweep_offset')
+                if offset is None:
+                    state['sweep_started'] = now
+                limit = self.sweep_pages * PAGE_SIZE
+                count = 0
+                offset_date = datetime.fromtimestamp(offset, timezone.utc) if offset else None
+                async for dialog in client.iter_dialogs(limit=limit, offset_date=offset_date,
+                                                        ignore_pinned=offset is not None):
+                    visit(dialog)
+                    count += 1
+                    if dialog.date:
+                        state['sweep_offset'] = dialog.date.timestamp()
+                finished = count < limit
+            except Exception as e:
+                logger.warning(f"Dialog sync interrupted, keeping progress so far: {e}")
+                state = {}
+                finished = False
+
+            dropped = []
+            if finished:
+                started = state.get('sweep_started', self.state.get('sweep_started', now))
+                seen = {chat_id for chat_id, _, _ in rows}
+                dropped = [
+                    chat_id for chat_id, seen_at in self.seen_at.items()
+                    if seen_at < started and chat_id not in seen
+                ]
+                for chat_id in dropped:
+                    self.chats.pop(chat_id, None)
+                state['sweep_offset'] = None
+
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._write, rows, dropped, state)
+            self.seen_at.update((chat_id, seen_at) for chat_id, _, seen_at in rows)
+            for chat_id in dropped:
+                self.seen_at.pop(chat_id, None)
+            for key, value in state.items():
+                if value is None:
+                    self.state.pop(key, None)
+                else:
+                    self.state[key] = value
+            return changed + len(dropped)
+
+    def _write(self, rows: List[Tuple[str, dict, float]], dropped: List[str], state: Dict[str, Optional[float]]):
+        with self.conn:
+            self.conn.executemany(
+                'INSERT INTO dialogs (chat_id, title, type, username, access_hash, seen_at)'
+                ' VALUES (?, ?, ?, ?, ?, ?)'
+                ' ON CONFLICT (chat_id) DO UPDATE SET title = excluded.title, type = excluded.type,'
+                ' username = excluded.username, access_hash = excluded.access_hash, seen_at = excluded.seen_at',
+                [
+                    (chat_id, info['title'], info['type'], info['username'], info['access_hash'], seen_at)
+                    for chat_id, info, seen_at in rows
+                ]
+            )
+            self.conn.executemany('DELETE FROM dialogs WHERE chat_id = ?', [(chat_id,) for chat_id in dropped])
+            for key, value in state.items():
+                if value is None:
+                    self.conn.execute('DELETE FROM sync_state WHERE key = ?', (key,))
+                else:
+                    self.conn.execute('INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)', (key, value))
+
+    def close(self):
+        self._executor.shutdown()
+        self.conn.close()
+
+
+def open_dialog_cache(settings: dict) -> DialogCache:
+    """Create the dialog cache from the ``dialog_sync`` config section"""
+    return DialogCache(
+        path=settings.get('path', 'dialogs.db'),
+        pages_per_sync=settings.get('pages_per_sync', 5),
+        sweep_pages=settings.get('sweep_pages', 2)
+    )
@@ -0,0 +1,230 @@
+# dispatcher.py
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from telethon.errors import FloodError, ServerError
+
+from metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+# Errors worth retrying after a short backoff; anything else fails the send
+TRANSIENT_ERRORS = (ServerError, ConnectionError, asyncio.TimeoutError)
+
+# Priority lanes: text, edits and deletes go in the fast lane, media in the bulk lane
+FAST = 'fast'
+BULK = 'bulk'
+LANES = (FAST, BULK)
+
+
+class TokenBucket:
+    """Rate limiter that hands out reservations instead of rejecting callers"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """Take a token and return how long to wait before it may be used"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class DispatchSlot:
+    """A reserved place in a destination's send queue for one lane"""
+
+    __slots__ = ('dispatcher', 'dest_id', 'lane', 'prev', 'started', 'reserved')
+
+    def __init__(self, dispatcher: 'SendDispatcher', dest_id: int, lane: str,
+                 prev: Optional[asyncio.Future], started: asyncio.Future):
+        self.dispatcher = dispatcher
+        self.dest_id = dest_id
+        self.lane = lane
+        self.prev = prev
+        self.started = started
+        self.reserved = time.monotonic()
+
+    async def run(self, func: Callable[..., Awaitable], *args, **kwargs):
+        """Run a send once every earlier slot for this destination and lane has started"""
+        return await self.dispatcher.run(self, func, *args, **kwargs)
+
+    def release(self):
+        """Give up the slot so later sends to the destination are not held back"""
+        self.dispatcher.release(self)
+
+
+class _Destination:
+    __slots__ = ('semaphores', 'bucket', 'paused_until')
+
+    def __init__(self, semaphores: Dict[str, asyncio.Semaphore], bucket: TokenBucket):
+        self.semaphores = semaphores
+        self.bucket = bucket
+        self.paused_until = 0.0
+
+
+class SendDispatcher:
+    """Sends to many destinations concurrently while keeping per-destination order.
+
+    Slots are reserved synchronously when an event arrives, so sends to one
+    destination start in the order their source events were received even if
+    slower work (such as a media download) happens in between.
+
+    Each destination has a fast and a bulk lane, ordered independently, so a
+    text message never waits for an earlier media message to the same chat.
+    The lanes also have separate budgets of concurrent sends, and media
+    downloads and uploads share ``max_concurrent_transfers``. The latency
+    from reservation to completed send is kept per lane.
+
+    Every send also takes a token from its destination's bucket and from the
+    account-wide bucket, waiting in line while either is empty. A FloodWait
+    pauses only the destination it was raised for and the send is retried
+    once the wait is over; transient server or network errors are retried
+    with exponential backoff.
+    """
+
+    def __init__(self, max_concurrent_sends: int = 8, max_sends_per_destination: int = 1,
+                 bulk_concurrent_sends: int = 2, max_concurrent_transfers: int = 2,
+                 global_rate: float = 25.0, global_burst: float = 30.0,
+                 per_chat_rate: float = 1.0, per_chat_burst: float = 3.0,
+                 max_retries: int = 3, retry_backoff: float = 1.0, max_flood_wait: float = 3600.0):
+        self.max_sends_per_destination = max_sends_per_destination
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.max_flood_wait = max_flood_wait
+        self._lanes = {
+            FAST: asyncio.Semaphore(max_concurrent_sends),
+            BULK: asyncio.Semaphore(bulk_concurrent_sends)
+        }
+        # Held while downloading or uploading media, outside any send slot
+        self.transfers = asyncio.Semaphore(max_concurrent_transfers)
+        self._global_bucket = TokenBucket(global_rate, global_burst)
+        self._destinations: Dict[int, _Destination] = {}
+        self._tails: Dict[Tuple[int, str], asyncio.Future] = {}
+        self.latency = {lane: Histogram() for lane in LANES}
+        self.flood_wait_seconds = 0.0
+
+    def reserve(self, dest_id: int, lane: str = FAST) -> DispatchSlot:
+        started = asyncio.get_running_loop().create_future()
+        prev = self._tails.get((dest_id, lane))
+        self._tails[(dest_id, lane)] = started
+        return DispatchSlot(self, dest_id, lane, prev, started)
+
+    def release(self, slot: DispatchSlot):
+        if not slot.started.done():
+            slot.started.set_result(None)
+        if self._tails.get((slot.dest_id, slot.lane)) is slot.started:
+            del self._tails[(slot.dest_id, slot.lane)]
+
+    async def run(self, slot: DispatchSlot, func: Callable[..., Awaitable], *args, **kwargs):
+        try:
+            if slot.prev is not None:
+                await slot.prev
+            destination = self._destination(slot.dest_id)
+            async with destination.semaphores[slot.lane]:
+                self.release(slot)
+                result = await self._send(slot.dest_id, slot.lane, destination, func, *args, **kwargs)
+            self.latency[slot.lane].observe(time.monotonic() - slot.reserved)
+            return result
+        finally:
+            self.release(slot)
+
+    async def _send(self, dest_id: int, lane: str, destination: _Destination,
+                    func: Callable[..., Awaitable], *args, **kwargs):
+        attempt = 0
+        while True:
+            paused = destination.paused_until - time.monotonic()
+            if paused > 0:
+                await asyncio.sleep(paused)
+
+            wait = max(destination.bucket.reserve(), self._global_bucket.reserve())
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            try:
+                async with self._lanes[lane]:
+                    return await func(*args, **kwargs)
+
+            except FloodError as e:
+                seconds = getattr(e, 'seconds', None) or self.retry_backoff * 2 ** attempt
+                if attempt >= self.max_retries or seconds > self.max_flood_wait:
+                    raise
+                destination.paused_until = time.monotonic() + seconds
+                self.flood_wait_seconds += seconds
+                logger.warning(f"Flood wait of {seconds}s for {dest_id}, pausing this destination")
+
+            except TRANSIENT_ERRORS as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.retry_backoff * 2 ** attempt
+                logger.warning(f"Send to {dest_id} failed ({e}), retrying in {delay}s")
+                await asyncio.sleep(delay)
+
+            attempt += 1
+
+    async def call(self, func: Callable[..., Awaitable], *args, **kwargs):
+        """Run a request that is not a send, such as a download, upload or lookup.
+
+        Clients are created with Telethon's own flood sleeping turned off so
+        that sends report FloodWaits here, so other requests wait them out in
+        this method instead. Transient errors are retried as for sends.
+        """
+        attempt = 0
+        while True:
+            try:
+                return await func(*args, **kwargs)
+
+            except FloodError as e:
+                seconds = getattr(e, 'seconds', None) or self.retry_backoff * 2 ** attempt
+                if attempt >= self.max_retries or seconds > self.max_flood_wait:
+                    raise
+                self.flood_wait_seconds += seconds
+                logger.warning(f"Flood wait of {seconds}s for {getattr(func, '__name__', func)}, retrying after it")
+                await asyncio.sleep(seconds)
+
+            except TRANSIENT_ERRORS as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.retry_backoff * 2 ** attempt
+                logger.warning(f"{getattr(func, '__name__', func)} failed ({e}), retrying in {delay}s")
+                await asyncio.sleep(delay)
+
+            attempt += 1
+
+    def _destination(self, dest_id: int) -> _Destination:
+        destination = self._destinations.get(dest_id)
+        if destination is None:
+            destination = _Destination(
+                {lane: asyncio.Semaphore(self.max_sends_per_destination) for lane in LANES},
+                TokenBucket(self.per_chat_rate, self.per_chat_burst)
+            )
+            self._destinations[dest_id] = destination
+        return destination
+
+
+def open_dispatcher(settings: dict) -> SendDispatcher:
+    """Create a dispatcher from the ``dispatch_settings`` config section"""
+    limits = settings.get('rate_limits', {})
+    return SendDispatcher(
+        max_concurrent_sends=settings.get('max_concurrent_sends', 8),
+        max_sends_per_destination=settings.get('max_sends_per_destination', 1),
+        bulk_concurrent_sends=settings.get('bulk_concurrent_sends', 2),
+        max_concurrent_transfers=settings.get('max_concurrent_transfers', 2),
+        global_rate=limits.get('global_per_second', 25.0),
+        global_burst=limits.get('global_burst', 30.0),
+        per_chat_rate=limits.get('per_chat_per_second', 1.0),
+        per_chat_burst=limits.get('per_chat_burst', 3.0),
+        max_retries=settings.get('max_retries', 3),
+        retry_backoff=settings.get('retry_backoff', 1.0),
+        max_flood_wait=settings.get('max_flood_wait', 3600.0)
+    )
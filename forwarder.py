@@ -1,16 +1,39 @@
 # forwarder.py
 import asyncio
-from telethon import TelegramClient, events
-from telethon.tl.functions.messages import GetDialogsRequest
-from telethon.tl.types import InputPeerEmpty, Channel, Chat, User
-from typing import Dict, Tuple, List
+from telethon import TelegramClient, events, utils
+from telethon.sessions import StringSession
+from telethon.errors import FloodError
+from telethon.tl.functions.messages import GetDialogsRequest, UploadMediaRequest
+from telethon.tl.types import (
+    InputPeerEmpty, InputPeerSelf,
+    MessageMediaPhoto, MessageMediaDocument, InputMediaUploadedPhoto, InputMediaUploadedDocument,
+    PhotoSizeProgressive
+)
+from typing import Awaitable, Dict, Tuple, List, Optional, Set
 import json
 import logging
 import socket
 import os
+import time
 from dotenv import load_dotenv
 import tempfile
+import argparse
 from mimetypes import guess_extension
+from functools import partial
+from dispatcher import FAST, LANES, TRANSIENT_ERRORS, DispatchSlot, open_dispatcher
+from accounts import Account, AccountRouter
+from text_rules import WordMatcher
+from rules import DestinationRule, RuleIndex
+from message_store import migrate_json_map, open_message_map
+from config_store import ConfigService
+from dialogs import open_dialog_cache
+from inbound import InboundEvent, open_inbound_queue
+from metrics import (
+    RuleCounters, StageMetrics, format_seconds, histogram_value, merge_families, merge_snapshots, render_prometheus
+)
+from permissions import RIGHTS_UPDATES, PermissionCache, rights_update_chat_id
+from workers import WorkerPool, decode_message, encode_message, session_string
+from ipc import read_frame, write_frame
 
 # Load environment variables
 load_dotenv()
@@ -22,98 +45,215 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+class MediaFetch:
+    """Media of a source message or album, downloaded once and uploaded once per sending account"""
+
+    def __init__(self, forwarder: 'Forwarder', messages: List):
+        self.forwarder = forwarder
+        self.messages = messages
+        self.temp_dir = None
+        self._downloads = None
+        self._uploads: Dict[str, asyncio.Future] = {}
+        # How long the shared transfers took, for the stage metrics
+        self.download_seconds = 0.0
+        self.upload_seconds: Dict[str, float] = {}
+        self.size = 0
+
+    def uploaded(self, account: Account) -> asyncio.Future:
+        """Media handles usable by the given account, fetched on first use"""
+        future = self._uploads.get(account.name)
+        if future is None:
+            if self._downloads is None:
+                self._downloads = asyncio.ensure_future(self.download_all())
+            future = self._uploads[account.name] = asyncio.ensure_future(self.upload(account))
+        return future
+
+    async def download_all(self) -> List[Tuple[object, str]]:
+        started = time.monotonic()
+        files = await asyncio.gather(*(self.download(m) for m in self.messages))
+        self.download_seconds = time.monotonic() - started
+        self.forwarder.media_bytes['downloaded'] += self.size
+        return files
+
+    async def download(self, message) -> Tuple[object, str]:
+        ext = self.forwarder.get_file_extension(message.media)
+        file_name = f"media{ext}"
+
+        # Small files stay in memory; only large ones are spilled to a temporary file
+        size = self.forwarder.get_media_size(message.media)
+        memory_limit = self.forwarder.config.get('media_memory_limit_mb', 20) * 1024 * 1024
+        dispatcher = self.forwarder.router.primary.dispatcher
+        if size is not None and size <= memory_limit:
+            async with dispatcher.transfers:
+                data = await dispatcher.call(message.download_media, file=bytes)
+            if not data:
+                raise ValueError("Downloaded media is empty")
+            self.size += len(data)
+            return data, file_name
+
+        if self.temp_dir is None:
+            self.temp_dir = tempfile.TemporaryDirectory()
+        temp_file = os.path.join(self.temp_dir.name, f"{message.id}{ext}")
+        async with dispatcher.transfers:
+            await dispatcher.call(message.download_media, file=temp_file)
+
+        if not os.path.exists(temp_file):
+            raise ValueError("Downloaded file not found")
+        self.size += os.path.getsize(temp_file)
+        return temp_file, file_name
+
+    async def upload(self, account: Account) -> List:
+        files = await self._downloads
+        started = time.monotonic()
+        async with account.dispatcher.transfers:
+            handles = await asyncio.gather(*(
+                self.forwarder.upload_media(account, message.media, file, file_name)
+                for message, (file, file_name) in zip(self.messages, files)
+            ))
+        self.upload_seconds[account.name] = time.monotonic() - started
+        self.forwarder.media_bytes['uploaded'] += self.size
+        return handles
+
+    def cleanup(self):
+        if self.temp_dir is not None:
+            self.temp_dir.cleanup()
+            self.temp_dir = None
+
 class Forwarder:
-    def __init__(self):
+    def __init__(self, worker_index: Optional[int] = None):
         self.api_id = os.getenv('API_ID')
         self.api_hash = os.getenv('API_HASH')
-        self.client = TelegramClient('forwarder_user', self.api_id, self.api_hash)
-        self.config = self.load_config()
+        # The single owner of config.json; other processes read it through the command socket
+        self.config_service = ConfigService('config.json', self.default_config())
+        # Bot UI connections that receive pushed config and chat list changes
+        self.watchers = set()
+        self.event_handlers = None
+        self.rules: Optional[RuleIndex] = None
+        self.compile_rules()
+        self.config_service.subscribe(self.config_changed)
         self.socket_server = None
-        self.lock = asyncio.Lock()
-        self.message_map: Dict[int, Dict[int, List[Tuple[int, int]]]] = {}
+        self.message_map = open_message_map(self.config['message_store'])
 
-    def load_config(self) -> dict:
-        try:
-            with open('config.json', 'r') as f:
-                config = json.load(f)
-                config.setdefault('forward_media_settings', {})
-                return config
-        except FileNotFoundError:
-            return {
-                'forwarding_rules': {},
-                'word_replacements': {},
-                'blacklist_words': [],
-                'approved_words': [],
-                'admins': [os.getenv('ADMIN_ID', '')],
-                'forward_media_settings': {}
-            }
-
-    def save_config(self):
-        try:
-            with open('config.json', 'w') as f:
-                json.dump(self.config, f, indent=4)
-        except Exception as e:
-            logger.error(f"Error saving config: {e}")
-    
-    # In forwarder.py (updated fetch_available_chats method)
-    async def fetch_available_chats(self):
-        """Fetch dialogs with proper ID formatting for all group types"""
-        try:
-            dialogs = []
-            async for dialog in self.client.iter_dialogs():  # Get all dialogs
-                dialogs.append(dialog)
-
-            chats = {}
-            for dialog in dialogs:
-                try:
-                    entity = dialog.entity
-                    if not entity:
-                        continue
-
-                    entity_id = getattr(entity, 'id', None)
-                    if entity_id is None:
-                        continue
-
-                    # Handle different entity types
-                    if isinstance(entity, Channel):
-                        if entity.megagroup:
-                            chat_id = f"-100{entity_id}"  # Supergroup
-                            chat_type = "supergroup"
-                        else:
-                            chat_id = str(entity_id)  # Channel
-                            chat_type = "channel"
-                    elif isinstance(entity, Chat):
-                        chat_id = str(entity_id)  # Basic group (already negative)
-                        chat_type = "group"
-                    elif isinstance(entity, User):
-                        chat_id = str(entity_id)  # Private chat
-                        chat_type = "user"
-                    else:
-                        continue
-
-                    # Get title safely
-                    title = getattr(entity, 'title', None) or \
-                            f"{getattr(entity, 'first_name', '')} {getattr(entity, 'last_name', '')}".strip()
-
-                    chats[chat_id] = {
-                        'title': title,
-                        'type': chat_type,
-                        'username': getattr(entity, 'username', None),
-                        'access_hash': getattr(entity, 'access_hash', None)
-                    }
-
-                except Exception as e:
-                    logger.error(f"Error processing dialog: {e}")
-                    continue
+        # Every session gets its own client and send scheduler; the first one also
+        # listens to the source chats. Flood waits are surfaced to the dispatcher,
+        # which pauses only the affected destination
+        account_settings = self.config['accounts']
+        self.worker_index = worker_index
+        self.accounts = [
+            Account(name, self.create_client(name), open_dispatcher(self.config['dispatch_settings']))
+            for name in account_settings.get('sessions') or ['forwarder_user']
+        ]
+        self.router = AccountRouter(self.accounts, account_settings.get('pins'))
+        self.client = self.router.primary.client
+        # Delete rights per destination, so deletes don't look them up every time
+        self.permissions = PermissionCache(self.config['dispatch_settings'].get('permission_ttl', 600))
+
+        # In supervisor mode this process only listens and hands messages to the workers
+        worker_settings = self.config['workers']
+        self.workers = None
+        if worker_index is None and worker_settings.get('count', 0) > 0:
+            self.workers = WorkerPool(
+                worker_settings['count'],
+                worker_settings.get('base_port', 65433),
+                os.path.abspath(__file__),
+                restart_delay=worker_settings.get('restart_delay', 5.0)
+            )
+        # Source events wait here for the consumer tasks, so handlers never block Telethon's update loop
+        self.inbound = open_inbound_queue(self.config['inbound_queue'])
+        # Sends of handled events, running in the background
+        self.sending: Set[asyncio.Task] = set()
+        # Time spent in each stage of handling events, per rule
+        self.stage_metrics = StageMetrics()
+        # Messages received, forwarded and blocked per rule, and media traffic, for /metrics
+        self.rule_counters = RuleCounters()
+        self.media_bytes = {'downloaded': 0, 'uploaded': 0}
+        self.metrics_server = None
+        self.pending_albums: Dict[Tuple[int, int], Tuple[List, List[Tuple[DestinationRule, DispatchSlot]],
+                                                         Dict[int, asyncio.Future]]] = {}
+        # Reserved sends of new messages that have not finished, per rule
+        self.pending_sends: Dict[Tuple[int, int], Set[DispatchSlot]] = {}
+        # Per source message, the destinations its copies are still on their way to, with the
+        # send (or earlier edit) that edits and deletes of the message there have to wait for
+        self.unsent: Dict[Tuple[int, int], Dict[int, asyncio.Future]] = {}
+
+        # Workers neither list chats nor serve the bot UI
+        self.dialogs = None
+        self.dialog_sync: Optional[asyncio.Task] = None
+        if worker_index is None:
+            self.dialogs = open_dialog_cache(self.config['dialog_sync'])
+            self.dialogs.seed(self.config.get('available_chats', {}))
+
+    def create_client(self, session_name: str) -> TelegramClient:
+        # Flood sleeping is off so sends surface FloodWaits to the dispatcher, which pauses
+        # only that destination; other requests wait them out through dispatcher.call
+        if self.worker_index is None:
+            return TelegramClient(session_name, self.api_id, self.api_hash, flood_sleep_threshold=0)
+        # Workers share the supervisor's logins; updates are received by the supervisor only
+        return TelegramClient(
+            StringSession(session_string(session_name)), self.api_id, self.api_hash,
+            flood_sleep_threshold=0, receive_updates=False
+        )
 
-            self.config['available_chats'] = chats
-            self.save_config()
-            return "Success: Chats fetched with proper ID formatting"
+    @property
+    def config(self) -> dict:
+        return self.config_service.config
 
+    def default_config(self) -> dict:
+        return {
+            'forwarding_rules': {},
+            'word_replacements': {},
+            'blacklist_words': [],
+            'approved_words': [],
+            'admins': [os.getenv('ADMIN_ID', '')],
+            'forward_media_settings': {},
+            'forward_mode_settings': {},
+            'forward_priority_settings': {},
+            'dispatch_settings': {},
+            'inbound_queue': {},
+            'accounts': {},
+            'workers': {},
+            'dialog_sync': {},
+            'message_store': {},
+            'metrics': {}
+        }
+
+    def config_changed(self, version: int):
+        """Apply a config change here and pass it on to the workers and watchers"""
+        self.compile_rules()
+        snapshot = self.config_service.snapshot()
+        if self.workers is not None:
+            self.workers.publish({'type': 'config', **snapshot})
+        self.push_event({'event': 'config', **snapshot})
+
+    async def fetch_available_chats(self):
+        """Start a dialog sync in the background and answer from the cache right away"""
+        if self.dialog_sync is None or self.dialog_sync.done():
+            self.dialog_sync = asyncio.create_task(self.sync_dialogs())
+        return f"Success: {len(self.dialogs.chats)} chats cached, refreshing in the background"
+
+    async def sync_dialogs(self):
+        try:
+            changed = await self.dialogs.sync(self.client)
+            if changed:
+                logger.info(f"Dialog sync: {changed} chats changed")
+                self.push_event({'event': 'chats', 'chats': self.dialogs.chats})
         except Exception as e:
-            logger.error(f"Error fetching dialogs: {e}")
-            return f"Error: {str(e)}"
+            logger.error(f"Error syncing dialogs: {e}")
 
+    async def maintain_dialogs(self):
+        """Sync the dialog cache on a schedule"""
+        interval = self.config['dialog_sync'].get('interval', 600)
+        while True:
+            if self.dialog_sync is None or self.dialog_sync.done():
+                self.dialog_sync = asyncio.create_task(self.sync_dialogs())
+            await asyncio.sleep(interval)
+
+    def push_event(self, event: dict):
+        for writer in list(self.watchers):
+            if writer.is_closing():
+                self.watchers.discard(writer)
+            else:
+                write_frame(writer, event)
 
     async def process_command(self, command: str) -> str:
         try:
@@ -128,25 +268,95 @@ class Forwarder:
 
             elif cmd_type == "start_forward":
                 source_id, dest_id, forward_media = parts[1], parts[2], parts[3].lower() == 'true'
-                async with self.lock:
-                    self.config.setdefault('forward_media_settings', {})
-                    if source_id not in self.config['forwarding_rules']:
-                        self.config['forwarding_rules'][source_id] = []
-                    if dest_id not in self.config['forwarding_rules'][source_id]:
-                        self.config['forwarding_rules'][source_id].append(dest_id)
-                    rule_key = f"{source_id}:{dest_id}"
-                    self.config['forward_media_settings'][rule_key] = forward_media
-                    self.save_config()
+                mutation = {'op': 'add_rule', 'source': source_id, 'dest': dest_id, 'media': forward_media}
+                # Optional fifth field picks "native" or "copy" forwarding for the rule
+                if len(parts) > 4:
+                    mutation['mode'] = parts[4]
+                self.config_service.mutate(mutation)
                 return f"Started forwarding from {source_id} to {dest_id}"
 
             elif cmd_type == "stop_forward":
                 source_id, dest_id = parts[1], parts[2]
                 return await self.stop_forwarding(source_id, dest_id)
 
+            elif cmd_type == "get_chats":
+                return json.dumps(self.dialogs.chats, ensure_ascii=False)
+
+            elif cmd_type == "get_config":
+                return json.dumps(self.config_service.snapshot(), ensure_ascii=False)
+
+            elif cmd_type == "mutate":
+                mutation = json.loads(command.partition(':')[2])
+                changed = self.config_service.mutate(mutation)
+                return json.dumps({'version': self.config_service.version, 'changed': changed})
+
+            elif cmd_type == "batch":
+                # A JSON list of mutations, applied all together or not at all
+                mutations = json.loads(command.partition(':')[2])
+                changed = self.config_service.mutate_many(mutations)
+                return json.dumps({'version': self.config_service.version, 'changed': changed})
+
+            elif cmd_type == "reload_config":
+                self.config_service.reload()
+                return "Success: Config reloaded"
+
+            elif cmd_type == "map_stats":
+                if self.workers is not None:
+                    return '\n'.join(
+                        f"Worker {index}: {response}"
+                        for index, response in enumerate(await self.workers.broadcast(command))
+                    )
+                stats = self.message_map.stats()
+                return (
+                    f"Message map: {stats['entries']} messages, {stats['mappings']} mappings "
+                    f"from {stats['sources']} sources, {stats['memory_bytes'] / 1024:.1f} KiB in memory, "
+                    f"{stats['stored']} stored"
+                )
+
+            elif cmd_type == "queue_stats":
+                if self.workers is not None:
+                    return '\n'.join(
+                        f"Worker {index}: {response}"
+                        for index, response in enumerate(await self.workers.broadcast(command))
+                    )
+                stats = self.inbound.stats()
+                return (
+                    f"Inbound queue: {stats['waiting']} events waiting from {stats['sources']} sources, "
+                    f"{len(self.sending)} being sent, "
+                    f"{stats['dropped']} shed, {stats['coalesced']} coalesced"
+                )
+
+            elif cmd_type == "lane_stats":
+                if self.workers is not None:
+                    return '\n'.join(
+                        f"Worker {index}: {response}"
+                        for index, response in enumerate(await self.workers.broadcast(command))
+                    )
+                lines = []
+                for account in self.accounts:
+                    for lane in LANES:
+                        latency = account.dispatcher.latency[lane]
+                        count = latency.count
+                        mean = latency.total / count if count else 0.0
+                        lines.append(
+                            f"{account.name} {lane} lane: {count} sends, mean {mean:.2f}s, "
+                            f"p50≤{format_seconds(latency.quantile(0.5))}, p99≤{format_seconds(latency.quantile(0.99))}"
+                        )
+                return '\n'.join(lines)
+
+            elif cmd_type == "stats":
+                # Stage latency histograms as JSON, added up over the workers
+                snapshots = [self.stage_metrics.snapshot()]
+                if self.workers is not None:
+                    snapshots = [json.loads(response) for response in await self.workers.broadcast(command)
+                                 if not response.startswith("Error")]
+                return json.dumps(merge_snapshots(snapshots))
+
+            elif cmd_type == "metrics":
+                return json.dumps(await self.gather_metrics())
+
             elif cmd_type == "stop_all":
-                self.config['forwarding_rules'] = {}
-                self.config['forward_media_settings'] = {}
-                self.save_config()
+                self.config_service.mutate({'op': 'clear_rules'})
                 return "Success: All forwarding rules stopped"
 
             else:
@@ -157,79 +367,395 @@ class Forwarder:
             return f"Error: {str(e)}"
         
 
-    async def handle_message(self, event):
+    async def route_message(self, event):
+        if event.chat_id in self.rules.routes:
+            self.workers.submit(event.chat_id, {'type': 'message', 'message': encode_message(event.message)})
+
+    async def route_edit(self, event):
+        if event.chat_id in self.rules.routes:
+            self.workers.submit(event.chat_id, {'type': 'edit', 'message': encode_message(event.message)})
+
+    async def route_delete(self, event):
+        if event.chat_id in self.rules.routes:
+            self.workers.submit(event.chat_id, {'type': 'delete', 'chat_id': event.chat_id, 'ids': event.deleted_ids})
+
+    async def handle_jobs(self, reader, writer):
+        """Run the jobs the supervisor sends to this worker.
+
+        Messages, edits and deletes go through the inbound queue in the order
+        they arrived, just like direct events.
+        """
         try:
-            source_id = str(event.chat_id)
-            if source_id not in self.config['forwarding_rules']:
-                return
+            while True:
+                job = await read_frame(reader)
+                if job is None:
+                    break
+                if job['type'] == 'config':
+                    self.config_service.replace(job['config'], job['version'])
+                elif job['type'] == 'command':
+                    asyncio.create_task(self.answer_job(writer, job))
+                elif job['type'] == 'delete':
+                    self.inbound.put(InboundEvent('delete', job['chat_id'], deleted_ids=job['ids']))
+                else:
+                    message = decode_message(job['message'], self.client)
+                    self.inbound.put(InboundEvent(
+                        job['type'], message.chat_id, message=message, media_lane=self.rules.media_lane(message.chat_id)
+                    ))
+        except Exception as e:
+            logger.error(f"Error reading jobs: {e}")
+        finally:
+            writer.close()
+
+    async def answer_job(self, writer, job: dict):
+        response = await self.process_command(job['command'])
+        write_frame(writer, {'id': job['id'], 'response': response})
+
+    async def queue_message(self, event):
+        self.inbound.put(InboundEvent(
+            'message', event.chat_id, message=event.message, media_lane=self.rules.media_lane(event.chat_id)
+        ))
+
+    async def queue_edit(self, event):
+        self.inbound.put(InboundEvent('edit', event.chat_id, message=event.message))
+
+    async def queue_delete(self, event):
+        self.inbound.put(InboundEvent('delete', event.chat_id, deleted_ids=event.deleted_ids))
+
+    async def consume_events(self, lane: str):
+        """Take queued source events of a lane and start handling them.
+
+        A handler filters and rewrites the event and reserves its destinations
+        without awaiting anything, so destinations are reserved in the order
+        events were taken from the queue. The sends it returns run in a task
+        of their own, so a destination paused by a FloodWait holds up only the
+        events sent to it.
+        """
+        handlers = {'message': self.handle_message, 'edit': self.handle_edit, 'delete': self.handle_delete}
+        while True:
+            event = await self.inbound.get(lane)
+            try:
+                sends = handlers[event.kind](event)
+            except Exception as e:
+                logger.error(f"Error handling {event.kind} from {event.chat_id}: {e}")
+                sends = None
+            if sends is None:
+                continue
+            task = asyncio.create_task(self.run_sends(event, sends))
+            self.sending.add(task)
+            task.add_done_callback(self.sending.discard)
+
+    async def run_sends(self, event: InboundEvent, sends: Awaitable):
+        try:
+            await sends
+        except Exception as e:
+            logger.error(f"Error sending {event.kind} from {event.chat_id}: {e}")
+
+    def start_consumers(self):
+        for lane in LANES:
+            asyncio.create_task(self.consume_events(lane))
+
+    def handle_message(self, event) -> Optional[Awaitable]:
+        """Filter a new message and reserve its destinations; returns the sends, if any"""
+        try:
+            rules = self.rules.destinations(event.chat_id)
+            if not rules:
+                return None
+
+            message = event.message
+            started = time.monotonic()
+            self.observe(event.chat_id, rules, 'receive', started - event.received)
+            self.count(event.chat_id, rules, 'received')
+
+            # Album items arrive as separate events; collect them and send them together
+            if message.grouped_id:
+                self.buffer_album(event.chat_id, rules, message, event.received)
+                return None
 
             # Check if message should be forwarded based on blacklist and approved words
-            if not self.should_forward_message(event.message.text or ''):
-                logger.info(f"Message blocked: {event.message.text[:50]}...")
+            forward = self.should_forward_message(message.text or '', rules[0])
+            self.observe(event.chat_id, rules, 'filter', time.monotonic() - started)
+            if not forward:
+                self.count(event.chat_id, rules, 'blocked')
+                logger.info(f"Message blocked: {(message.text or '')[:50]}...")
+                return None
+
+            slots = self.reserve_destinations(event.chat_id, rules, bool(message.media))
+            if not slots:
+                return None
+            return self.forward_messages(event.chat_id, [message], slots)
+
+        except Exception as e:
+            logger.error(f"Error in handle_message: {e}")
+            return None
+
+    def observe(self, source_id: int, rules: Tuple[DestinationRule, ...], stage: str, seconds: float):
+        """Record how long a stage took for each of the rules it was done for"""
+        for rule in rules:
+            self.stage_metrics.observe((source_id, rule.dest_id), stage, seconds)
+
+    def count(self, source_id: int, rules: Tuple[DestinationRule, ...], name: str, amount: int = 1):
+        for rule in rules:
+            self.rule_counters.add(name, (source_id, rule.dest_id), amount)
+
+    def reserve_destinations(self, source_id: int, rules: Tuple[DestinationRule, ...],
+                             media: bool) -> List[Tuple[DestinationRule, DispatchSlot]]:
+        """Reserve each destination's place in line before any slow work, so that
+        per-destination ordering follows the order source messages arrived in.
+
+        Media goes in the bulk lane unless the rule sends text only or sets
+        its own lane in ``forward_priority_settings``. A destination that
+        already has ``max_pending_per_destination`` messages of this source
+        waiting to be sent, e.g. while it is paused by a long FloodWait, is
+        skipped, so its backlog stays bounded without holding up the others.
+        """
+        limit = self.config['dispatch_settings'].get('max_pending_per_destination', 1000)
+        slots = []
+        for rule in rules:
+            pending = self.pending_sends.setdefault((source_id, rule.dest_id), set())
+            if len(pending) >= limit:
+                self.count(source_id, (rule,), 'shed')
+                if self.rule_counters.counts['shed'][(source_id, rule.dest_id)] % 1000 == 1:
+                    logger.warning(f"{len(pending)} messages from {source_id} waiting for {rule.dest_id}, shedding")
+                continue
+            slot = self.reserve(rule.dest_id, rule.send_lane(media))
+            pending.add(slot)
+            slots.append((rule, slot))
+        return slots
+
+    def release_slot(self, source_id: int, slot: DispatchSlot):
+        """Give up a slot of a new message, whether it was used or not"""
+        slot.release()
+        pending = self.pending_sends.get((source_id, slot.dest_id))
+        if pending is not None:
+            pending.discard(slot)
+            if not pending:
+                del self.pending_sends[(source_id, slot.dest_id)]
+
+    def reserve(self, dest_id: int, lane: str = FAST) -> DispatchSlot:
+        """Reserve a send slot with the account that owns the destination"""
+        return self.router.account_for(dest_id).dispatcher.reserve(dest_id, lane)
+
+    def client_for(self, dest_id: int) -> TelegramClient:
+        return self.router.account_for(dest_id).client
+
+    def track_send(self, source_id: int, msg_ids: List[int], dest_id: int,
+                   sent: Optional[asyncio.Future] = None) -> asyncio.Future:
+        """Note that copies of source messages are on their way to a destination;
+        edits and deletes of them there wait until ``sent`` is done"""
+        if sent is None:
+            sent = asyncio.get_running_loop().create_future()
+        for msg_id in msg_ids:
+            self.unsent.setdefault((source_id, msg_id), {})[dest_id] = sent
+        return sent
+
+    def untrack_send(self, source_id: int, msg_ids: List[int], dest_id: int, sent: asyncio.Future):
+        if not sent.done():
+            sent.set_result(None)
+        for msg_id in msg_ids:
+            unsent = self.unsent.get((source_id, msg_id))
+            # A later edit may have taken its place already
+            if unsent is not None and unsent.get(dest_id) is sent:
+                del unsent[dest_id]
+                if not unsent:
+                    del self.unsent[(source_id, msg_id)]
+
+    def buffer_album(self, source_id: int, rules: Tuple[DestinationRule, ...], message, received: float):
+        key = (source_id, message.grouped_id)
+        album = self.pending_albums.get(key)
+        if album is None:
+            slots = self.reserve_destinations(source_id, rules, True)
+            loop = asyncio.get_running_loop()
+            album = self.pending_albums[key] = ([], slots, {slot.dest_id: loop.create_future() for _, slot in slots})
+            asyncio.create_task(self.flush_album(key, received))
+        album[0].append(message)
+        for dest_id, sent in album[2].items():
+            self.track_send(source_id, [message.id], dest_id, sent)
+
+    async def flush_album(self, key: Tuple[int, int], received: float):
+        """Forward a buffered album once no more of its items are expected.
+
+        The window runs from when the first item was received, not from when
+        it was taken from the inbound queue, so items that queued behind it
+        are still collected.
+        """
+        await asyncio.sleep(received + self.config.get('album_window', 0.5) - time.monotonic())
+        messages, slots, sent = self.pending_albums.pop(key)
+        source_id = key[0]
+        if not slots:
+            return
+        try:
+            messages.sort(key=lambda m: m.id)
+            text = ' '.join(m.text for m in messages if m.text)
+            started = time.monotonic()
+            forward = self.should_forward_message(text, slots[0][0])
+            self.observe(source_id, tuple(rule for rule, _ in slots), 'filter', time.monotonic() - started)
+            if not forward:
+                self.count(source_id, tuple(rule for rule, _ in slots), 'blocked', len(messages))
+                logger.info(f"Album blocked: {text[:50]}...")
                 return
 
-            for dest_id in self.config['forwarding_rules'][source_id]:
-                try:
-                    rule_key = f"{source_id}:{dest_id}"
-                    forward_media = self.config['forward_media_settings'].get(rule_key, True)
-
-                    # Handle media forwarding
-                    if event.message.media and forward_media:
-                        media = event.message.media
-                        ext = self.get_file_extension(media)
-                        
-                        with tempfile.TemporaryDirectory() as temp_dir:
-                            try:
-                                temp_file = os.path.join(temp_dir, f"media{ext}")
-                                await event.message.download_media(file=temp_file)
-                                
-                                if not os.path.exists(temp_file):
-                                    raise ValueError("Downloaded file not found")
-
-                                # Process caption
-                                caption = self.process_message_text(event.message.text) if event.message.text else None
-                                
-                                # Send media file
-                                sent_msg = await self.client.send_file(
-                                    int(dest_id),
-                                    temp_file,
-                                    caption=caption,
-                                    force_document=False
-                                )
-
-                                # Update message map for edit tracking
-                                self.message_map.setdefault(source_id, {})
-                                self.message_map[source_id].setdefault(event.message.id, [])
-                                self.message_map[source_id][event.message.id].append((int(dest_id), sent_msg.id))
-
-                            except Exception as e:
-                                logger.error(f"Error in handle_message: {e}")
-                                continue
-
-                    # Handle text messages
-                    elif event.message.text:
-                        processed_text = self.process_message_text(event.message.text)
-                        
-                        # Send processed text message
-                        sent_msg = await self.client.send_message(
-                            int(dest_id),
-                            processed_text
-                        )
+            await self.forward_messages(source_id, messages, slots)
 
-                        # Update message map for edit tracking
-                        self.message_map.setdefault(source_id, {})
-                        self.message_map[source_id].setdefault(event.message.id, [])
-                        self.message_map[source_id][event.message.id].append((int(dest_id), sent_msg.id))
+        except Exception as e:
+            logger.error(f"Error forwarding album: {e}")
+        finally:
+            for _, slot in slots:
+                self.release_slot(source_id, slot)
+            for dest_id, album_sent in sent.items():
+                self.untrack_send(source_id, [m.id for m in messages], dest_id, album_sent)
 
-                    # Periodically save message map to persist across restarts
-                    if len(self.message_map.get(source_id, {})) % 10 == 0:
-                        self.save_message_map()
+    def forward_messages(self, source_id: int, messages: List,
+                         slots: List[Tuple[DestinationRule, DispatchSlot]]) -> Awaitable:
+        """Prepare a message, or all items of an album, for every reserved destination.
+
+        The text is rewritten right away; the returned awaitable does the sends.
+        """
+        sends = []
+        try:
+            has_media = any(m.media for m in messages)
+            # All rules of one index share the compiled replacements, so the text is rewritten once
+            started = time.monotonic()
+            captions = [self.process_message_text(m.text, slots[0][0]) if m.text else None for m in messages]
+            self.observe(source_id, tuple(rule for rule, _ in slots), 'replace', time.monotonic() - started)
+            # Native forwarding only applies when the word replacements leave the text untouched
+            unchanged = all(caption == m.text for m, caption in zip(messages, captions))
+            text = '\n\n'.join(caption for caption in captions if caption)
+            text_messages = [m for m in messages if m.text]
+            media_items = [(m, caption) for m, caption in zip(messages, captions) if m.media]
+            # Fetched and uploaded once, shared by every destination that needs it
+            media = MediaFetch(self, [m for m, _ in media_items])
 
-                except Exception as e:
-                    logger.error(f"Error sending to {dest_id}: {e}")
+            async def send_media(dest_id: int):
+                handles = await media.uploaded(self.router.account_for(dest_id))
+                client = self.client_for(dest_id)
+                # A single item is sent as a plain message, several as one album
+                if len(handles) > 1:
+                    captions = [caption or '' for _, caption in media_items]
+                    return await client.send_file(dest_id, handles, caption=captions, force_document=False)
+                return await client.send_file(dest_id, handles[0], caption=media_items[0][1], force_document=False)
 
+            async def send_text(dest_id: int):
+                return await self.client_for(dest_id).send_message(dest_id, text)
+
+            for rule, slot in slots:
+                native = unchanged and rule.native
+                if has_media and rule.forward_media:
+                    send, mapped = send_media, [m for m, _ in media_items]
+                elif text_messages:
+                    send, mapped = send_text, text_messages
+                    native = native and not has_media
+                else:
+                    self.release_slot(source_id, slot)
+                    continue
+
+                if native:
+                    sends.append((slot, messages, partial(self.send_native, messages, send), None))
+                else:
+                    sends.append((slot, mapped, send, media if send is send_media else None))
+        except Exception:
+            for _, slot in slots:
+                self.release_slot(source_id, slot)
+            raise
+        # Edits and deletes that come in before a copy is sent wait for it
+        return self.run_forward(source_id, [
+            self.send_to(slot, source_id, mapped, send,
+                         self.track_send(source_id, [m.id for m in mapped], slot.dest_id), media=shared)
+            for slot, mapped, send, shared in sends
+        ], media, slots)
+
+    async def run_forward(self, source_id: int, sends: List[Awaitable], media: MediaFetch,
+                          slots: List[Tuple[DestinationRule, DispatchSlot]]):
+        try:
+            await asyncio.gather(*sends)
+        finally:
+            media.cleanup()
+            for _, slot in slots:
+                self.release_slot(source_id, slot)
+
+    async def send_to(self, slot, source_id: int, messages: List, send, tracked: asyncio.Future,
+                      media: Optional[MediaFetch] = None):
+        """Run one destination's send in its slot and record the resulting message ids"""
+        rule = (source_id, slot.dest_id)
+        try:
+            # Wait for shared media outside the slot so downloads don't hold a send slot
+            if media is not None:
+                account = self.router.account_for(slot.dest_id)
+                await media.uploaded(account)
+                self.stage_metrics.observe(rule, 'download', media.download_seconds)
+                self.stage_metrics.observe(rule, 'upload', media.upload_seconds[account.name])
+            started = time.monotonic()
+            sent = await slot.run(send, slot.dest_id)
+            sent = sent if isinstance(sent, list) else [sent]
+            sent_at = time.monotonic()
+            self.stage_metrics.observe(rule, 'send', sent_at - started)
+
+            # Update message map for edit tracking; a combined text message stands in for every item
+            pairs = zip(messages, sent) if len(sent) == len(messages) else ((m, sent[0]) for m in messages)
+            for message, sent_msg in pairs:
+                self.record_mapping(source_id, message.id, slot.dest_id, sent_msg.id)
+            self.stage_metrics.observe(rule, 'persist', time.monotonic() - sent_at)
+            self.rule_counters.add('forwarded', rule, len(messages))
         except Exception as e:
-            logger.error(f"Error in handle_message: {e}")
+            logger.error(f"Error sending to {slot.dest_id}: {e}")
+        finally:
+            # The destination's other sends don't wait for this source message's siblings
+            self.untrack_send(source_id, [m.id for m in messages], slot.dest_id, tracked)
+            self.release_slot(source_id, slot)
+
+    async def send_native(self, messages: List, fallback, dest_id: int):
+        """Re-send messages by reference without downloading them, keeping their formatting.
+
+        Falls back to rebuilding the message when Telegram refuses, e.g. for
+        chats with protected content or expired file references.
+        """
+        client = self.client_for(dest_id)
+        try:
+            if len(messages) == 1:
+                return await client.send_message(dest_id, messages[0])
+            return await client.send_file(
+                dest_id,
+                [m.media for m in messages],
+                caption=[m.text or '' for m in messages]
+            )
+        except (FloodError,) + TRANSIENT_ERRORS:
+            raise
+        except Exception as e:
+            logger.warning(f"Native forward to {dest_id} failed ({e}), rebuilding the message")
+            return await fallback(dest_id)
+
+    async def upload_media(self, account: Account, media, file, file_name: str = None):
+        """Upload a file once and turn it into media that every destination can send by reference"""
+        client, call = account.client, account.dispatcher.call
+        file_handle = await call(client.upload_file, file, file_name=file_name)
+        if isinstance(media, MessageMediaPhoto):
+            input_media = InputMediaUploadedPhoto(file_handle)
+        elif isinstance(media, MessageMediaDocument):
+            input_media = InputMediaUploadedDocument(
+                file_handle,
+                mime_type=media.document.mime_type or 'application/octet-stream',
+                attributes=media.document.attributes
+            )
+        else:
+            return file_handle
+
+        uploaded = await call(client, UploadMediaRequest(InputPeerSelf(), input_media))
+        return utils.get_input_media(uploaded)
+
+    def record_mapping(self, source_id: int, src_msg_id: int, dest_chat_id: int, dest_msg_id: int):
+        """Remember where a source message was forwarded to for edit/delete sync"""
+        self.message_map.add(source_id, src_msg_id, dest_chat_id, dest_msg_id)
+
+    def get_media_size(self, media) -> Optional[int]:
+        """Size in bytes of the media's largest file, if Telegram tells us"""
+        if isinstance(media, MessageMediaDocument) and media.document:
+            return media.document.size
+        if isinstance(media, MessageMediaPhoto) and media.photo:
+            sizes = [
+                max(size.sizes) if isinstance(size, PhotoSizeProgressive) else getattr(size, 'size', 0)
+                for size in media.photo.sizes
+            ]
+            return max(sizes, default=None)
+        return None
 
     def get_file_extension(self, media):
         """Get appropriate file extension for media type"""
@@ -247,122 +773,321 @@ class Forwarder:
     async def stop_forwarding(self, source_id: str, dest_id: str):
         """Enhanced stop forwarding with cleanup"""
         try:
-            if source_id in self.config['forwarding_rules']:
-                if dest_id in self.config['forwarding_rules'][source_id]:
-                    self.config['forwarding_rules'][source_id].remove(dest_id)
-                    if not self.config['forwarding_rules'][source_id]:
-                        del self.config['forwarding_rules'][source_id]
-                    rule_key = f"{source_id}:{dest_id}"
-                    if rule_key in self.config['forward_media_settings']:
-                        del self.config['forward_media_settings'][rule_key]
-                    self.save_config()
-                    return f"Stopped forwarding from {source_id} to {dest_id}"
+            if self.config_service.mutate({'op': 'remove_rule', 'source': source_id, 'dest': dest_id}):
+                return f"Stopped forwarding from {source_id} to {dest_id}"
             return f"No forwarding rule found from {source_id} to {dest_id}"
         except Exception as e:
             logger.error(f"Error in stop_forwarding: {e}")
             return f"Error: {str(e)}"
 
-    async def handle_edit(self, event):
+    def handle_edit(self, event) -> Optional[Awaitable]:
+        """Rewrite an edited message and reserve the destinations of its copies; returns the edits, if any"""
         try:
-            source_id = str(event.chat_id)
-            if source_id not in self.config['forwarding_rules']:
-                return
+            rules = self.rules.destinations(event.chat_id)
+            if not rules:
+                return None
 
             if not event.message.text:
-                return
+                return None
 
-            if not self.should_forward_message(event.message.text):
-                return
+            started = time.monotonic()
+            self.observe(event.chat_id, rules, 'receive', started - event.received)
+            forward = self.should_forward_message(event.message.text, rules[0])
+            filtered = time.monotonic()
+            self.observe(event.chat_id, rules, 'filter', filtered - started)
+            if not forward:
+                return None
 
-            processed_text = self.process_message_text(event.message.text)
+            processed_text = self.process_message_text(event.message.text, rules[0])
+            self.observe(event.chat_id, rules, 'replace', time.monotonic() - filtered)
 
             src_chat_id = event.chat_id
             src_msg_id = event.message.id
 
-            logger.info(f"Edit event: chat {src_chat_id}, msg {src_msg_id}")
-            logger.info(f"Current message_map: {self.message_map}")
-            logger.info(f"Message text: {event.message.text}")
-            logger.info(f"Forwarding rules: {self.config['forwarding_rules']}")
+            # Copies still on their way to a destination are edited there once they have been sent
+            unsent = self.unsent.get((src_chat_id, src_msg_id), {})
+            entries = [
+                (dest_chat_id, dest_msg_id) for dest_chat_id, dest_msg_id in self.message_map.get(src_chat_id, src_msg_id)
+                if int(dest_chat_id) not in unsent
+            ]
+            logger.info(
+                f"Edit event: chat {src_chat_id}, msg {src_msg_id}, {len(entries)} forwarded copies, "
+                f"{len(unsent)} destinations still being sent to"
+            )
 
-            if source_id in self.config['forwarding_rules']:
-                logger.info(f"Destinations for {source_id}: {self.config['forwarding_rules'][source_id]}")
+            edits = []
+            for dest_chat_id, sent in list(unsent.items()):
+                # A later edit of the message waits for this one to take its place in line
+                reserved = self.track_send(src_chat_id, [src_msg_id], dest_chat_id)
+                edits.append(self.edit_when_sent(src_chat_id, src_msg_id, dest_chat_id, sent, reserved, processed_text))
+            if entries:
+                slots = [self.reserve(int(dest_chat_id)) for dest_chat_id, _ in entries]
+                edits.append(self.edit_copies(
+                    src_chat_id, slots, [dest_msg_id for _, dest_msg_id in entries], processed_text))
+            if not edits:
+                return None
+            return asyncio.gather(*edits)
 
-            if (source_id in self.message_map and
-                src_msg_id in self.message_map[source_id]):
+        except Exception as e:
+            logger.error(f"Error in handle_edit: {e}")
+            return None
 
-                for dest_chat_id, dest_msg_id in self.message_map[source_id][src_msg_id]:
-                    try:
-                        await self.client.edit_message(dest_chat_id, dest_msg_id, processed_text)
-                        logger.info(f"Updated forwarded message in {dest_chat_id}")
-                    except Exception as e:
-                        logger.error(f"Error updating message in {dest_chat_id}: {e}")
+    async def edit_copies(self, source_id: int, slots: List[DispatchSlot], dest_msg_ids: List[int], text: str):
+        try:
+            await asyncio.gather(*(
+                self.edit_forwarded(slot, source_id, dest_msg_id, text)
+                for slot, dest_msg_id in zip(slots, dest_msg_ids)
+            ))
+        finally:
+            for slot in slots:
+                slot.release()
 
+    async def edit_when_sent(self, source_id: int, msg_id: int, dest_id: int, sent: asyncio.Future,
+                             reserved: asyncio.Future, text: str):
+        """Edit the copies of a message in a destination once its send, or the edit before, is in line"""
+        try:
+            await asyncio.shield(sent)
+            copies = [
+                dest_msg_id for dest_chat_id, dest_msg_id in self.message_map.get(source_id, msg_id)
+                if int(dest_chat_id) == dest_id
+            ]
+            slots = [self.reserve(dest_id) for _ in copies]
+        finally:
+            self.untrack_send(source_id, [msg_id], dest_id, reserved)
+        if copies:
+            await self.edit_copies(source_id, slots, copies, text)
+
+    async def edit_forwarded(self, slot, source_id: int, dest_msg_id: int, text: str):
+        try:
+            started = time.monotonic()
+            await slot.run(self.client_for(slot.dest_id).edit_message, slot.dest_id, dest_msg_id, text)
+            self.stage_metrics.observe((source_id, slot.dest_id), 'edit', time.monotonic() - started)
+            logger.info(f"Updated forwarded message in {slot.dest_id}")
         except Exception as e:
-            logger.error(f"Error in handle_edit: {e}")
+            logger.error(f"Error updating message in {slot.dest_id}: {e}")
 
-    async def handle_delete(self, event):
+    def handle_delete(self, event) -> Optional[Awaitable]:
+        """Look up the copies of deleted messages and reserve their destinations; returns the deletes, if any"""
         try:
-            source_id = str(event.chat_id)
-            if source_id not in self.config['forwarding_rules']:
-                return
+            rules = self.rules.destinations(event.chat_id)
+            if not rules:
+                return None
+            self.observe(event.chat_id, rules, 'receive', time.monotonic() - event.received)
 
+            # Copies grouped by destination chat, so each destination gets one request
+            targets: Dict[int, List[Tuple[int, int]]] = {}
+            # Copies still on their way to a destination are deleted there once they have been sent
+            later: Dict[int, Tuple[List[int], List[asyncio.Future]]] = {}
             for msg_id in event.deleted_ids:
-                if source_id in self.message_map and msg_id in self.message_map[source_id]:
-                    entries = self.message_map[source_id][msg_id].copy()
-                    
-                    for dest_chat_id, dest_msg_id in entries:
-                        try:
-                            # Check delete permissions first
-                            chat = await self.client.get_entity(int(dest_chat_id))
-                            if not isinstance(chat, User):  # Skip PMs
-                                if not (await self.client.get_permissions(int(dest_chat_id))).is_admin:
-                                    logger.warning(f"No delete permissions in {dest_chat_id}")
-                                    continue
-                                
-                            await self.client.delete_messages(int(dest_chat_id), dest_msg_id)
-                            # Remove only if successful
-                            self.message_map[source_id][msg_id].remove((dest_chat_id, dest_msg_id))
-                            
-                        except Exception as e:
-                            logger.error(f"Delete failed in {dest_chat_id}: {str(e)}")
-                            continue
-                    
-                    # Cleanup empty entries
-                    if not self.message_map[source_id][msg_id]:
-                        del self.message_map[source_id][msg_id]
-                    self.save_message_map()
-                    
+                unsent = self.unsent.get((event.chat_id, msg_id), {})
+                for dest_chat_id, sent in unsent.items():
+                    msg_ids, waiting = later.setdefault(dest_chat_id, ([], []))
+                    msg_ids.append(msg_id)
+                    waiting.append(sent)
+                for dest_chat_id, dest_msg_id in self.message_map.get(event.chat_id, msg_id):
+                    if int(dest_chat_id) not in unsent:
+                        targets.setdefault(int(dest_chat_id), []).append((msg_id, dest_msg_id))
+
+            deletes = [
+                self.delete_when_sent(event.chat_id, dest_chat_id, msg_ids, waiting)
+                for dest_chat_id, (msg_ids, waiting) in later.items()
+            ]
+            if targets:
+                slots = [self.reserve(dest_chat_id) for dest_chat_id in targets]
+                deletes.append(self.delete_copies(event.chat_id, slots, targets))
+            if not deletes:
+                return None
+            return asyncio.gather(*deletes)
+
         except Exception as e:
             logger.error(f"Delete handler error: {str(e)}")
+            return None
+
+    async def delete_copies(self, source_id: int, slots: List[DispatchSlot], targets: Dict[int, List[Tuple[int, int]]]):
+        try:
+            results = await asyncio.gather(*(
+                self.delete_forwarded(slot, source_id, [dest_msg_id for _, dest_msg_id in copies])
+                for slot, copies in zip(slots, targets.values())
+            ))
+        finally:
+            for slot in slots:
+                slot.release()
+
+        for (dest_chat_id, copies), deleted in zip(targets.items(), results):
+            # Remove only if successful
+            if deleted:
+                started = time.monotonic()
+                for msg_id, dest_msg_id in copies:
+                    self.message_map.remove(source_id, msg_id, dest_chat_id, dest_msg_id)
+                self.stage_metrics.observe((source_id, dest_chat_id), 'persist', time.monotonic() - started)
+
+    async def delete_when_sent(self, source_id: int, dest_id: int, msg_ids: List[int],
+                               waiting: List[asyncio.Future]):
+        """Delete the copies of messages in a destination once their sends there have finished"""
+        await asyncio.gather(*(asyncio.shield(sent) for sent in waiting))
+        copies = [
+            (msg_id, dest_msg_id) for msg_id in msg_ids
+            for dest_chat_id, dest_msg_id in self.message_map.get(source_id, msg_id) if int(dest_chat_id) == dest_id
+        ]
+        if copies:
+            await self.delete_copies(source_id, [self.reserve(dest_id)], {dest_id: copies})
+
+    async def delete_forwarded(self, slot, source_id: int, dest_msg_ids: List[int]) -> bool:
+        dest_chat_id = slot.dest_id
+        account = self.router.account_for(dest_chat_id)
+        client = account.client
+        try:
+            # Check delete permissions first
+            if not await self.permissions.can_delete(client, dest_chat_id, account.dispatcher.call):
+                logger.warning(f"No delete permissions in {dest_chat_id}")
+                return False
+
+            started = time.monotonic()
+            await slot.run(client.delete_messages, dest_chat_id, dest_msg_ids)
+            self.stage_metrics.observe((source_id, dest_chat_id), 'delete', time.monotonic() - started)
+            return True
 
-    def process_message_text(self, text: str) -> str:
+        except Exception as e:
+            logger.error(f"Delete failed in {dest_chat_id}: {str(e)}")
+            return False
+
+    async def handle_chat_action(self, event):
+        # Someone joined, left or was removed; that may have been us
+        self.permissions.invalidate(event.chat_id)
+
+    async def handle_rights_update(self, update):
+        self.permissions.invalidate(rights_update_chat_id(update))
+
+    def compile_rules(self):
+        """Rebuild the rule index from the config and swap it in"""
+        self.rules = RuleIndex(self.config, self.rules)
+        if self.event_handlers is not None:
+            self.register_handlers()
+
+    def register_handlers(self):
+        """Subscribe to events from the chats that have rules only, so events from
+        other chats are dropped by Telethon before they reach the handlers"""
+        on_message, on_edit, on_delete = self.event_handlers
+        for callback in self.event_handlers:
+            self.client.remove_event_handler(callback)
+
+        # An empty chats filter would match every chat
+        chats = list(self.rules.routes)
+        if not chats:
+            return
+        self.client.add_event_handler(on_message, events.NewMessage(chats=chats))
+        self.client.add_event_handler(on_edit, events.MessageEdited(chats=chats))
+        self.client.add_event_handler(on_delete, events.MessageDeleted(chats=chats))
+
+    def process_message_text(self, text: str, rule: DestinationRule) -> str:
         if not text:
             return text
 
-        processed_text = text
-        for old_word, new_word in self.config['word_replacements'].items():
-            processed_text = processed_text.replace(old_word, new_word)
-
-        return processed_text
+        return rule.replacer.apply(text)
 
-    def should_forward_message(self, text: str) -> bool:
+    def should_forward_message(self, text: str, rule: DestinationRule) -> bool:
         if not text:
             return False
 
-        text_lower = text.lower()
+        verdict = rule.matcher.check(text)
 
-        if any(word.lower() in text_lower for word in self.config['blacklist_words']):
+        if verdict == WordMatcher.BLOCKED:
             logger.info(f"Message blocked by blacklist: {text[:50]}...")
             return False
 
-        """if self.config['approved_words']:
-            should_forward = any(word.lower() in text_lower for word in self.config['approved_words'])
-            if not should_forward:
-                logger.info(f"Message doesn't contain any approved words: {text[:50]}...")
-            return should_forward"""
+        if verdict == WordMatcher.NOT_APPROVED:
+            logger.info(f"Message doesn't contain any approved words: {text[:50]}...")
+            return False
 
         return True
 
+    def collect_metrics(self) -> dict:
+        """This process's metrics, as families for the Prometheus export"""
+        def family(kind: str, help_text: str, samples: list) -> dict:
+            return {'type': kind, 'help': help_text, 'samples': samples}
+
+        return {
+            'forwarder_messages_received_total': family(
+                'counter', "Source messages received, per rule", self.rule_counters.samples('received')),
+            'forwarder_messages_forwarded_total': family(
+                'counter', "Messages delivered to the destination, per rule", self.rule_counters.samples('forwarded')),
+            'forwarder_messages_blocked_total': family(
+                'counter', "Messages stopped by the word filters, per rule", self.rule_counters.samples('blocked')),
+            'forwarder_messages_shed_total': family(
+                'counter', "Messages not sent because too many were waiting for the destination, per rule",
+                self.rule_counters.samples('shed')),
+            'forwarder_send_latency_seconds': family('histogram', "Time from reserving a send until it was delivered", [
+                [{'account': account.name, 'lane': lane}, histogram_value(account.dispatcher.latency[lane])]
+                for account in self.accounts for lane in LANES
+            ]),
+            'forwarder_stage_seconds': family('histogram', "Time spent in each stage of handling an event, per rule", [
+                [{'rule': f"{source_id}:{dest_id}", 'stage': stage}, histogram_value(histogram)]
+                for (source_id, dest_id), stages in self.stage_metrics.histograms.items()
+                for stage, histogram in stages.items()
+            ]),
+            'forwarder_flood_wait_seconds_total': family('counter', "Seconds of FloodWait imposed by Telegram", [
+                [{'account': account.name}, account.dispatcher.flood_wait_seconds] for account in self.accounts
+            ]),
+            'forwarder_inbound_queue_depth': family(
+                'gauge', "Source events waiting to be handled", [[{}, len(self.inbound)]]),
+            'forwarder_inbound_shed_total': family(
+                'counter', "Source events dropped because the inbound queue was full", [[{}, self.inbound.dropped]]),
+            'forwarder_message_map_entries': family(
+                'gauge', "Source messages with mappings cached in memory", [[{}, len(self.message_map)]]),
+            'forwarder_media_downloaded_bytes_total': family(
+                'counter', "Bytes of media downloaded", [[{}, self.media_bytes['downloaded']]]),
+            'forwarder_media_uploaded_bytes_total': family(
+                'counter', "Bytes of media uploaded", [[{}, self.media_bytes['uploaded']]])
+        }
+
+    async def gather_metrics(self) -> dict:
+        """The metrics of this process, added up with those of the workers"""
+        processes = [self.collect_metrics()]
+        if self.workers is not None:
+            processes += [json.loads(response) for response in await self.workers.broadcast("metrics")
+                          if not response.startswith("Error")]
+        return merge_families(processes)
+
+    async def start_metrics_server(self):
+        """Serve /metrics over HTTP for Prometheus, if a port is configured"""
+        settings = self.config['metrics']
+        if not settings.get('port'):
+            return
+        server = await asyncio.start_server(
+            self.handle_metrics_client,
+            settings.get('host', 'localhost'),
+            settings['port']
+        )
+        self.metrics_server = server
+        logger.info(f"Serving metrics on port {settings['port']}")
+        async with server:
+            await server.serve_forever()
+
+    async def handle_metrics_client(self, reader, writer):
+        """Answer one HTTP request; only GET /metrics is served"""
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+            while (await asyncio.wait_for(reader.readline(), 10)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status = "200 OK"
+                body = render_prometheus(await self.gather_metrics()).encode('utf-8')
+            else:
+                status = "404 Not Found"
+                body = b"Not Found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode('ascii') + body
+            )
+            await writer.drain()
+        except Exception as e:
+            logger.error(f"Error serving metrics: {e}")
+        finally:
+            writer.close()
+
     async def start_socket_server(self):
         server = await asyncio.start_server(
             self.handle_socket_client,
@@ -374,59 +1099,138 @@ class Forwarder:
             await server.serve_forever()
 
     async def handle_socket_client(self, reader, writer):
+        """Serve a persistent bot UI connection.
+
+        Every request is answered by its own task, so a slow command such as
+        fetch_chats does not hold up the ones sent after it.
+        """
         try:
-            data = await reader.read(1024)
-            command = data.decode('utf-8')
-            response = await self.process_command(command)
-            writer.write(response.encode('utf-8'))
-            await writer.drain()
+            while True:
+                request = await read_frame(reader)
+                if request is None:
+                    break
+                asyncio.create_task(self.answer_request(writer, request))
+        except Exception as e:
+            logger.error(f"Error reading from command socket: {e}")
         finally:
+            self.watchers.discard(writer)
             writer.close()
-            await writer.wait_closed()
-
-    def save_message_map(self):
-        with open('message_map.json', 'w') as f:
-            serializable_map = {
-                str(k): {str(k2): v for k2, v in v.items()}
-                for k, v in self.message_map.items()
-            }
-            json.dump(serializable_map, f)
-
-    # In load_message_map()
-    def load_message_map(self):
+
+    async def answer_request(self, writer, request: dict):
+        command = request.get('command', '')
+        if command == "watch_config":
+            # Every later change is pushed as a config event
+            self.watchers.add(writer)
+            response = json.dumps(self.config_service.snapshot(), ensure_ascii=False)
+        else:
+            response = await self.process_command(command)
+        if not writer.is_closing():
+            write_frame(writer, {'id': request.get('id'), 'response': response})
+            await writer.drain()
+
+    async def maintain_message_map(self):
+        """Periodically evict idle mappings from memory, compact the store and prune old mappings"""
+        settings = self.config['message_store']
+        while True:
+            await asyncio.sleep(settings.get('maintenance_interval', 300))
+            try:
+                expired = self.message_map.expire()
+                pruned = 0
+                # The database is shared by all worker processes; only one of them compacts it
+                if self.message_map.store is not None and self.worker_index is None:
+                    retention_days = settings.get('retention_days')
+                    older_than = time.time() - retention_days * 86400 if retention_days else None
+                    pruned = await self.message_map.store.maintain(older_than)
+                if expired or pruned:
+                    logger.info(f"Message map maintenance: {expired} evicted from memory, {pruned} pruned from disk")
+            except Exception as e:
+                logger.error(f"Error maintaining message map: {e}")
+
+    async def load_dialogs(self, account: Account):
+        # Clients that never see the source events need their dialogs loaded up
+        # front to be able to resolve destination ids. A failure only means some
+        # ids resolve later, so it must not keep the process from starting
+        async def read_all():
+            async for _ in account.client.iter_dialogs():
+                pass
+
         try:
-            with open('message_map.json', 'r') as f:
-                data = json.load(f)
-                self.message_map = {
-                    str(k): {int(msg_id): dest_messages for msg_id, dest_messages in v.items()}
-                    for k, v in data.items()
-                }
-        except (FileNotFoundError, json.JSONDecodeError):
-            self.message_map = {}
-        except FileNotFoundError:
-            self.message_map = {}
-            with open('message_map.json', 'w') as f:
-                json.dump({}, f)
-        except json.JSONDecodeError:
-            logger.warning("Invalid message_map.json, resetting")
-            self.message_map = {}
-            with open('message_map.json', 'w') as f:
-                json.dump({}, f)
-                
+            await account.dispatcher.call(read_all)
+        except Exception as e:
+            logger.error(f"Error loading dialogs of {account.name}: {e}")
+
     async def start(self):
-        await self.client.start()
-        self.load_message_map()
+        if self.worker_index is not None:
+            await self.run_worker()
+            return
+
+        # Every session is logged in here, so the workers can copy the logins
+        for account in self.accounts:
+            await account.client.start()
+        if self.workers is None:
+            for account in self.accounts[1:]:
+                await self.load_dialogs(account)
+        if self.message_map.store is not None:
+            await migrate_json_map(self.message_map.store)
+            asyncio.create_task(self.message_map.store.run())
+        asyncio.create_task(self.maintain_message_map())
+        asyncio.create_task(self.maintain_dialogs())
         asyncio.create_task(self.start_socket_server())
-        self.client.add_event_handler(self.handle_message, events.NewMessage())
-        self.client.add_event_handler(self.handle_edit, events.MessageEdited())
-        self.client.add_event_handler(self.handle_delete, events.MessageDeleted())
+        asyncio.create_task(self.start_metrics_server())
+        if self.workers is None:
+            self.start_consumers()
+            self.event_handlers = (self.queue_message, self.queue_edit, self.queue_delete)
+            # Each session has its own rights in its destinations
+            for account in self.accounts:
+                account.client.add_event_handler(self.handle_chat_action, events.ChatAction())
+                account.client.add_event_handler(self.handle_rights_update, events.Raw(RIGHTS_UPDATES))
+        else:
+            # Workers start from the current config rather than a file that may be mid-save
+            self.workers.publish({'type': 'config', **self.config_service.snapshot()})
+            await self.workers.start()
+            self.event_handlers = (self.route_message, self.route_edit, self.route_delete)
+        self.register_handlers()
         logger.info("Forwarder started successfully!")
         try:
             await self.client.run_until_disconnected()
         finally:
             if self.socket_server:
                 self.socket_server.close()
+            if self.metrics_server:
+                self.metrics_server.close()
+            if self.workers is not None:
+                await self.workers.stop()
+            for account in self.accounts[1:]:
+                await account.client.disconnect()
+            await self.config_service.flush()
+            self.dialogs.close()
+            self.message_map.close()
+
+    async def run_worker(self):
+        """Forward the messages the supervisor sends for this worker's share of the sources"""
+        for account in self.accounts:
+            await account.client.connect()
+            if not await account.client.is_user_authorized():
+                raise RuntimeError(f"Session {account.name} is not logged in")
+            await self.load_dialogs(account)
+        if self.message_map.store is not None:
+            asyncio.create_task(self.message_map.store.run())
+        asyncio.create_task(self.maintain_message_map())
+        self.start_consumers()
+        port = self.config['workers'].get('base_port', 65433) + self.worker_index
+        server = await asyncio.start_server(self.handle_jobs, 'localhost', port)
+        logger.info(f"Worker {self.worker_index} listening on port {port}")
+        try:
+            await self.client.run_until_disconnected()
+        finally:
+            server.close()
+            for account in self.accounts[1:]:
+                await account.client.disconnect()
+            self.message_map.close()
 
 if __name__ == "__main__":
-    forwarder = Forwarder()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--worker', type=int, help="run as the worker process with this index")
+    args = parser.parse_args()
+    forwarder = Forwarder(worker_index=args.worker)
     asyncio.run(forwarder.start())
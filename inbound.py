@@ -0,0 +1,203 @@
+# inbound.py
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from dispatcher import BULK, FAST, LANES
+
+logger = logging.getLogger(__name__)
+
+# Shedding ranks: media, edits, text messages, deletions
+RANKS = 4
+
+
+class InboundEvent:
+    """A new message, edit or deletion from a source chat, waiting to be handled.
+
+    It has the ``chat_id``, ``message`` and ``deleted_ids`` attributes the
+    handlers read, so it is passed to them in place of the Telethon event.
+    A new media message waits in ``media_lane``, picked from the source's
+    rules; everything else waits in the fast lane.
+    """
+
+    __slots__ = ('kind', 'chat_id', 'message', 'deleted_ids', 'media', 'lane', 'received', 'seq')
+
+    def __init__(self, kind: str, chat_id: int, message=None, deleted_ids: Optional[List[int]] = None,
+                 media_lane: str = BULK):
+        self.kind = kind
+        self.chat_id = chat_id
+        self.message = message
+        self.deleted_ids = deleted_ids
+        self.media = kind == 'message' and bool(getattr(message, 'media', None))
+        self.lane = media_lane if self.media else FAST
+        self.received = time.monotonic()
+        self.seq = 0  # Arrival order, set when queued
+
+
+class InboundQueue:
+    """Source events waiting for the consumer tasks, in one FIFO per source chat and lane.
+
+    New media messages that every destination sends in its bulk lane wait in
+    the bulk lane and everything else in the fast lane, each with its own
+    consumer, so text is not held up behind media. Within a lane, events are
+    taken from the sources in turn, so a flood from one source delays every
+    other source by at most one event per turn. Events of one source and lane
+    are taken in the order they arrived.
+
+    Edits of a message that is still waiting update it instead of being queued,
+    and a deletion drops the waiting new messages and edits it covers.
+
+    When a source has ``per_source_high_water`` events waiting, or all sources
+    together ``high_water``, an event is shed from that source (or from the one
+    with most events waiting): media messages first if ``drop_media_first``,
+    then edits, then text messages, the oldest of a kind first. Deletions are
+    never shed. Each source and lane keeps one FIFO per kind of event, so the
+    event to shed is at the head of one of them and is removed outright.
+    """
+
+    def __init__(self, high_water: int = 10000, per_source_high_water: int = 1000, drop_media_first: bool = True):
+        self.high_water = high_water
+        self.per_source_high_water = per_source_high_water
+        self.drop_media_first = drop_media_first
+        # One FIFO per shedding rank for each lane and source; emptied ones are removed when their turn comes
+        self._queues: Dict[Tuple[str, int], List[Deque[InboundEvent]]] = {}
+        # Sources with events queued in each lane, in turn order
+        self._ready: Dict[str, Deque[int]] = {lane: deque() for lane in LANES}
+        self._counts: Dict[int, int] = {}  # Events waiting per source, not counting shed ones
+        self._waiting: Dict[Tuple[int, int], InboundEvent] = {}  # Queued messages and edits by message
+        self._size = 0
+        self._seq = 0
+        self._available = {lane: asyncio.Event() for lane in LANES}
+        self.dropped = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return self._size
+
+    def _rank(self, event: InboundEvent) -> int:
+        if event.kind == 'message':
+            return 0 if event.media and self.drop_media_first else 2
+        return 1 if event.kind == 'edit' else 3
+
+    def put(self, event: InboundEvent):
+        source = event.chat_id
+        if event.kind == 'delete':
+            deleted_ids = []
+            for msg_id in event.deleted_ids:
+                waiting = self._waiting.get((source, msg_id))
+                if waiting is not None:
+                    self._discard(waiting)
+                    self.coalesced += 1
+                    # A new message that was never sent has no copies to delete
+                    if waiting.kind == 'message':
+                        continue
+                deleted_ids.append(msg_id)
+            if not deleted_ids:
+                return
+            event.deleted_ids = deleted_ids
+        else:
+            key = (source, event.message.id)
+            waiting = self._waiting.get(key)
+            if waiting is not None and event.kind == 'edit':
+                waiting.message = event.message
+                self.coalesced += 1
+                return
+
+            if self._counts.get(source, 0) >= self.per_source_high_water:
+                if not self._shed(source, event):
+                    return
+            elif self._size >= self.high_water:
+                if not self._shed(max(self._counts, key=self._counts.get), event):
+                    return
+            self._waiting[key] = event
+
+        queues = self._queues.get((event.lane, source))
+        if queues is None:
+            queues = self._queues[(event.lane, source)] = [deque() for _ in range(RANKS)]
+            self._ready[event.lane].append(source)
+        self._seq += 1
+        event.seq = self._seq
+        queues[self._rank(event)].append(event)
+        self._counts[source] = self._counts.get(source, 0) + 1
+        self._size += 1
+        self._available[event.lane].set()
+
+    def _shed(self, source: int, incoming: InboundEvent) -> bool:
+        """Drop the least important waiting event of a source; returns False if that is the incoming one"""
+        victim = None
+        # The oldest event of the lowest rank, from either lane; deletions are never shed
+        for rank in range(RANKS - 1):
+            for lane in LANES:
+                queues = self._queues.get((lane, source))
+                if queues and queues[rank] and (victim is None or queues[rank][0].seq < victim.seq):
+                    victim = queues[rank][0]
+            if victim is not None:
+                break
+
+        self.dropped += 1
+        if self.dropped % 1000 == 1:
+            logger.warning(f"Inbound queue full, shedding events ({self.dropped} so far)")
+        if victim is None or self._rank(incoming) < self._rank(victim):
+            return False
+        self._discard(victim)
+        return True
+
+    def _discard(self, event: InboundEvent):
+        queue = self._queues[(event.lane, event.chat_id)][self._rank(event)]
+        if queue[0] is event:
+            queue.popleft()
+        else:
+            queue.remove(event)
+        self._forget(event)
+        # Nothing keeps a reference to a discarded event, but free the message right away anyway
+        event.message = None
+
+    def _forget(self, event: InboundEvent):
+        remaining = self._counts[event.chat_id] - 1
+        if remaining:
+            self._counts[event.chat_id] = remaining
+        else:
+            del self._counts[event.chat_id]
+        self._size -= 1
+        if event.kind != 'delete' and self._waiting.get((event.chat_id, event.message.id)) is event:
+            del self._waiting[(event.chat_id, event.message.id)]
+
+    async def get(self, lane: str = FAST) -> InboundEvent:
+        """Take the next event of a lane, from the source whose turn it is"""
+        ready = self._ready[lane]
+        while True:
+            while ready:
+                source = ready.popleft()
+                queues = self._queues[(lane, source)]
+                waiting = [queue for queue in queues if queue]
+                if not waiting:
+                    del self._queues[(lane, source)]
+                    continue
+                event = min(waiting, key=lambda queue: queue[0].seq).popleft()
+                if len(waiting) > 1 or waiting[0]:
+                    ready.append(source)
+                else:
+                    del self._queues[(lane, source)]
+                self._forget(event)
+                return event
+            self._available[lane].clear()
+            await self._available[lane].wait()
+
+    def stats(self) -> dict:
+        return {
+            'waiting': self._size,
+            'sources': len(self._counts),
+            'dropped': self.dropped,
+            'coalesced': self.coalesced
+        }
+
+
+def open_inbound_queue(settings: dict) -> InboundQueue:
+    """Create the inbound queue from the ``inbound_queue`` config section"""
+    return InboundQueue(
+        high_water=settings.get('high_water', 10000),
+        per_source_high_water=settings.get('per_source_high_water', 1000),
+        drop_media_first=settings.get('drop_media_first', True)
+    )
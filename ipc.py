@@ -0,0 +1,118 @@
+# ipc.py
+import asyncio
+import itertools
+import json
+import logging
+import struct
+from typing import Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Frames are a 4-byte big-endian length followed by a UTF-8 JSON object
+_HEADER = struct.Struct('>I')
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Optional[dict]:
+    """Read one frame, or return None once the peer has closed the connection"""
+    try:
+        header = await reader.readexactly(_HEADER.size)
+    except asyncio.IncompleteReadError:
+        return None
+    (length,) = _HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {length} bytes exceeds the limit")
+    return json.loads(await reader.readexactly(length))
+
+
+def write_frame(writer: asyncio.StreamWriter, payload: dict):
+    data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    writer.write(_HEADER.pack(len(data)) + data)
+
+
+class IPCClient:
+    """A persistent connection to the forwarder's command socket.
+
+    Every request carries an id, so any number can be in flight and replies
+    may come back in any order. Frames without an id are events pushed by the
+    forwarder and go to ``on_event``. ``run()`` keeps the connection open and
+    reconnects after it drops; ``on_connect`` runs after every connect, e.g.
+    to subscribe to events again.
+    """
+
+    def __init__(self, host: str, port: int,
+                 on_event: Optional[Callable[[dict], None]] = None,
+                 on_connect: Optional[Callable[[], Awaitable]] = None,
+                 timeout: float = 30.0, retry_delay: float = 2.0):
+        self.host = host
+        self.port = port
+        self.on_event = on_event
+        self.on_connect = on_connect
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._connected = asyncio.Event()
+        self._ids = itertools.count(1)
+        self._pending: Dict[int, asyncio.Future] = {}
+
+    async def run(self):
+        while True:
+            try:
+                reader, self._writer = await asyncio.open_connection(self.host, self.port)
+            except OSError as e:
+                logger.warning(f"Cannot reach forwarder: {e}")
+                await asyncio.sleep(self.retry_delay)
+                continue
+
+            logger.info("Connected to forwarder")
+            self._connected.set()
+            if self.on_connect is not None:
+                asyncio.create_task(self.on_connect())
+            try:
+                while True:
+                    frame = await read_frame(reader)
+                    if frame is None:
+                        break
+                    self._dispatch(frame)
+            except Exception as e:
+                logger.warning(f"Connection to forwarder failed: {e}")
+            finally:
+                self._connected.clear()
+                self._writer.close()
+                self._writer = None
+                for future in self._pending.values():
+                    if not future.done():
+                        future.set_exception(ConnectionError("Connection to forwarder lost"))
+                self._pending.clear()
+            await asyncio.sleep(self.retry_delay)
+
+    def _dispatch(self, frame: dict):
+        request_id = frame.get('id')
+        if request_id is None:
+            if self.on_event is not None:
+                try:
+                    self.on_event(frame)
+                except Exception as e:
+                    logger.error(f"Error handling forwarder event: {e}")
+            return
+        future = self._pending.pop(request_id, None)
+        if future is not None and not future.done():
+            future.set_result(frame.get('response', ''))
+
+    async def request(self, command: str, timeout: Optional[float] = None) -> str:
+        timeout = timeout or self.timeout
+        try:
+            await asyncio.wait_for(self._connected.wait(), self.retry_delay * 2)
+        except asyncio.TimeoutError:
+            raise RuntimeError("Forwarder service is not running")
+
+        request_id = next(self._ids)
+        future = self._pending[request_id] = asyncio.get_running_loop().create_future()
+        try:
+            write_frame(self._writer, {'id': request_id, 'command': command})
+            await self._writer.drain()
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise RuntimeError("Forwarder communication timeout")
+        finally:
+            self._pending.pop(request_id, None)
@@ -0,0 +1,377 @@
+# message_store.py
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+from abc import ABC, abstractmethod
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+Mapping = Tuple[int, int]
+
+
+class MessageStore(ABC):
+    """Where forwarded copies of each source message live, for edit/delete sync"""
+
+    @abstractmethod
+    def add(self, source_chat_id: int, source_msg_id: int, dest_chat_id: int, dest_msg_id: int):
+        pass
+
+    def add_many(self, rows: List[Tuple[int, int, int, int]]):
+        for row in rows:
+            self.add(*row)
+
+    @abstractmethod
+    def get(self, source_chat_id: int, source_msg_id: int) -> List[Mapping]:
+        pass
+
+    @abstractmethod
+    def remove(self, source_chat_id: int, source_msg_id: int, dest_chat_id: int, dest_msg_id: int):
+        pass
+
+    @abstractmethod
+    def count(self) -> int:
+        pass
+
+    async def run(self):
+        """Background persistence work, if the store needs any"""
+
+    async def flush(self):
+        """Write out anything that is queued"""
+
+    async def maintain(self, older_than: Optional[float] = None) -> int:
+        """Compact the store and drop mappings created before ``older_than``"""
+        return 0
+
+    def close(self):
+        pass
+
+
+class SQLiteMessageStore(MessageStore):
+    """Mappings in an SQLite database in WAL mode, written behind in batches.
+
+    Rows are clustered on (source chat, source message), so edit and delete
+    lookups are index seeks and nothing needs to be loaded at startup.
+
+    Adds and removes are queued in memory and committed as one transaction by
+    a writer thread once ``batch_size`` records are pending or
+    ``flush_interval`` seconds have passed, so the event loop never waits on
+    the disk. The WAL is the append-only journal: SQLite replays it on the
+    next open after a crash, and ``maintain()`` checkpoints it back into the
+    database. ``synchronous`` picks whether each batch is fsynced (``FULL``)
+    or only at checkpoints (``NORMAL``).
+    """
+
+    def __init__(self, path: str = 'message_map.db', batch_size: int = 100,
+                 flush_interval: float = 1.0, synchronous: str = 'NORMAL'):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending: List[Tuple[str, tuple]] = []
+        self._flushing: List[Tuple[str, tuple]] = []
+        self._wakeup = asyncio.Event()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='message-store')
+
+        # Worker processes share the database; wait for each other's batches instead of failing
+        self.writer = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.writer.execute('PRAGMA journal_mode=WAL')
+        self.writer.execute(f'PRAGMA synchronous={synchronous}')
+        self.writer.execute(
+            'CREATE TABLE IF NOT EXISTS message_map ('
+            ' source_chat_id INTEGER NOT NULL,'
+            ' source_msg_id INTEGER NOT NULL,'
+            ' dest_chat_id INTEGER NOT NULL,'
+            ' dest_msg_id INTEGER NOT NULL,'
+            ' created_at REAL NOT NULL,'
+            ' PRIMARY KEY (source_chat_id, source_msg_id, dest_chat_id, dest_msg_id)'
+            ') WITHOUT ROWID'
+        )
+        self.writer.commit()
+        self.reader = sqlite3.connect(path)
+
+    def _queue(self, op: str, row: tuple):
+        self._pending.append((op, row))
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    def add(self, source_chat_id, source_msg_id, dest_chat_id, dest_msg_id):
+        self._queue('add', (source_chat_id, source_msg_id, dest_chat_id, dest_msg_id, time.time()))
+
+    def add_many(self, rows):
+        now = time.time()
+        for row in rows:
+            self._queue('add', (*row, now))
+
+    def remove(self, source_chat_id, source_msg_id, dest_chat_id, dest_msg_id):
+        self._queue('remove', (source_chat_id, source_msg_id, dest_chat_id, dest_msg_id))
+
+    def get(self, source_chat_id, source_msg_id):
+        cursor = self.reader.execute(
+            'SELECT dest_chat_id, dest_msg_id FROM message_map'
+            ' WHERE source_chat_id = ? AND source_msg_id = ?',
+            (source_chat_id, source_msg_id)
+        )
+        pairs = cursor.fetchall()
+
+        # Overlay records that have not reached the database yet
+        for op, row in self._flushing + self._pending:
+            if row[0] != source_chat_id or row[1] != source_msg_id:
+                continue
+            pair = (row[2], row[3])
+            if op == 'add' and pair not in pairs:
+                pairs.append(pair)
+            elif op == 'remove' and pair in pairs:
+                pairs.remove(pair)
+        return pairs
+
+    def count(self):
+        stored = self.reader.execute('SELECT COUNT(*) FROM message_map').fetchone()[0]
+        return stored + sum(1 if op == 'add' else -1 for op, _ in self._flushing + self._pending)
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing message mappings: {e}")
+
+    async def flush(self):
+        if not self._pending or self._flushing:
+            return
+        self._flushing, self._pending = self._pending, []
+        try:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._write_batch, self._flushing)
+        except Exception:
+            # Keep the records so the next flush retries them
+            self._pending = self._flushing + self._pending
+            raise
+        finally:
+            self._flushing = []
+
+    def _write_batch(self, batch: List[Tuple[str, tuple]]):
+        with self.writer:
+            for op, row in batch:
+                if op == 'add':
+                    self.writer.execute('INSERT OR REPLACE INTO message_map VALUES (?, ?, ?, ?, ?)', row)
+                else:
+                    self.writer.execute(
+                        'DELETE FROM message_map WHERE source_chat_id = ? AND source_msg_id = ?'
+                        ' AND dest_chat_id = ? AND dest_msg_id = ?',
+                        row
+                    )
+
+    async def maintain(self, older_than=None):
+        await self.flush()
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._compact, older_than)
+
+    def _compact(self, older_than: Optional[float]) -> int:
+        pruned = 0
+        if older_than is not None:
+            with self.writer:
+                pruned = self.writer.execute('DELETE FROM message_map WHERE created_at < ?', (older_than,)).rowcount
+        self.writer.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return pruned
+
+    def close(self):
+        # Whatever is still queued is written synchronously on shutdown
+        if self._pending:
+            self._executor.submit(self._write_batch, self._pending).result()
+            self._pending = []
+        self._executor.shutdown()
+        self.reader.close()
+        self.writer.close()
+
+
+class _CachedMessage:
+    """Forwarded copies of one source message, packed as (chat, msg) pairs"""
+
+    __slots__ = ('touched', 'dests')
+
+    def __init__(self, touched: float, dests: array):
+        self.touched = touched
+        self.dests = dests
+
+    def pairs(self) -> List[Mapping]:
+        dests = self.dests
+        return [(dests[i], dests[i + 1]) for i in range(0, len(dests), 2)]
+
+
+class MessageMap:
+    """Bounded in-memory map of recent messages in front of a persistent store.
+
+    Entries are evicted least-recently-used first once the global or
+    per-source limit is reached, and after ``max_age`` seconds without being
+    used. Evicted entries stay in the store and are read back on demand, so
+    edits and deletes of old messages still work when a store is configured.
+    """
+
+    def __init__(self, store: Optional[MessageStore] = None, max_entries: int = 50000,
+                 max_entries_per_source: int = 10000, max_age: float = 7 * 24 * 3600):
+        self.store = store
+        self.max_entries = max_entries
+        self.max_entries_per_source = max_entries_per_source
+        self.max_age = max_age
+        self._entries: 'OrderedDict[Tuple[int, int], _CachedMessage]' = OrderedDict()
+        self._sources: Dict[int, 'OrderedDict[int, None]'] = {}
+        self._evicted: Dict[int, int] = {}  # Highest message id evicted per source
+
+    def add(self, source_chat_id: int, source_msg_id: int, dest_chat_id: int, dest_msg_id: int):
+        key = (source_chat_id, source_msg_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            # Copies sent before the entry was evicted are only in the store; an entry without
+            # them would hide them from later edits and deletes. Message ids grow, so a new
+            # message is above every id evicted from its source and needs no read
+            stored = []
+            if self.store is not None and source_msg_id <= self._evicted.get(source_chat_id, 0):
+                stored = self.store.get(source_chat_id, source_msg_id)
+            entry = _CachedMessage(time.monotonic(), array('q', [n for pair in stored for n in pair]))
+            self._insert(key, entry)
+        else:
+            self._touch(key, entry)
+        entry.dests.extend((dest_chat_id, dest_msg_id))
+
+        if self.store is not None:
+            self.store.add(source_chat_id, source_msg_id, dest_chat_id, dest_msg_id)
+
+    def get(self, source_chat_id: int, source_msg_id: int) -> List[Mapping]:
+        key = (source_chat_id, source_msg_id)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._touch(key, entry)
+            return entry.pairs()
+
+        if self.store is None:
+            return []
+        pairs = self.store.get(source_chat_id, source_msg_id)
+        if pairs:
+            self._insert(key, _CachedMessage(time.monotonic(), array('q', [n for pair in pairs for n in pair])))
+        return pairs
+
+    def remove(self, source_chat_id: int, source_msg_id: int, dest_chat_id: int, dest_msg_id: int):
+        key = (source_chat_id, source_msg_id)
+        entry = self._entries.get(key)
+        if entry is not None:
+            pairs = [pair for pair in entry.pairs() if pair != (dest_chat_id, dest_msg_id)]
+            if pairs:
+                entry.dests = array('q', [n for pair in pairs for n in pair])
+            else:
+                self._evict(key)
+
+        if self.store is not None:
+            self.store.remove(source_chat_id, source_msg_id, dest_chat_id, dest_msg_id)
+
+    def expire(self) -> int:
+        """Evict entries that have not been used for ``max_age`` seconds"""
+        cutoff = time.monotonic() - self.max_age
+        expired = 0
+        # Entries are kept in least-recently-used order, so stop at the first fresh one
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry.touched >= cutoff:
+                break
+            self._evict(key)
+            expired += 1
+        return expired
+
+    def __len__(self):
+        """Source messages whose mappings are cached in memory"""
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        memory = sys.getsizeof(self._entries) + sys.getsizeof(self._sources)
+        for key, entry in self._entries.items():
+            memory += sys.getsizeof(key) + sys.getsizeof(entry) + sys.getsizeof(entry.dests)
+        for source in self._sources.values():
+            memory += sys.getsizeof(source)
+        return {
+            'entries': len(self._entries),
+            'mappings': sum(len(entry.dests) // 2 for entry in self._entries.values()),
+            'sources': len(self._sources),
+            'memory_bytes': memory,
+            'stored': self.store.count() if self.store is not None else None
+        }
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+
+    def _insert(self, key: Tuple[int, int], entry: _CachedMessage):
+        self._entries[key] = entry
+        source = self._sources.setdefault(key[0], OrderedDict())
+        source[key[1]] = None
+
+        if len(source) > self.max_entries_per_source:
+            self._evict((key[0], next(iter(source))))
+        if len(self._entries) > self.max_entries:
+            self._evict(next(iter(self._entries)))
+
+    def _touch(self, key: Tuple[int, int], entry: _CachedMessage):
+        entry.touched = time.monotonic()
+        self._entries.move_to_end(key)
+        self._sources[key[0]].move_to_end(key[1])
+
+    def _evict(self, key: Tuple[int, int]):
+        del self._entries[key]
+        if key[1] > self._evicted.get(key[0], 0):
+            self._evicted[key[0]] = key[1]
+        source = self._sources[key[0]]
+        del source[key[1]]
+        if not source:
+            del self._sources[key[0]]
+
+
+def open_message_map(settings: dict) -> MessageMap:
+    """Create the message map described by the ``message_store`` config section"""
+    backend = settings.get('backend', 'sqlite')
+    if backend == 'sqlite':
+        store = SQLiteMessageStore(
+            settings.get('path', 'message_map.db'),
+            batch_size=settings.get('batch_size', 100),
+            flush_interval=settings.get('flush_interval', 1.0),
+            synchronous='FULL' if settings.get('fsync', False) else 'NORMAL'
+        )
+    elif backend == 'memory':
+        store = None
+    else:
+        raise ValueError(f"Unknown message store backend: {backend}")
+
+    return MessageMap(
+        store,
+        max_entries=settings.get('cache_max_entries', 50000),
+        max_entries_per_source=settings.get('cache_max_entries_per_source', 10000),
+        max_age=settings.get('cache_max_age', 7 * 24 * 3600)
+    )
+
+
+async def migrate_json_map(store: MessageStore, path: str = 'message_map.json'):
+    """Import a legacy message_map.json into the store once, then set the file aside"""
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return
+
+    rows = [
+        (int(source_id), int(msg_id), int(dest_chat_id), int(dest_msg_id))
+        for source_id, messages in data.items()
+        for msg_id, entries in messages.items()
+        for dest_chat_id, dest_msg_id in entries
+    ]
+    store.add_many(rows)
+    await store.flush()
+
+    os.replace(path, f"{path}.migrated")
+    logger.info(f"Migrated {len(rows)} message mappings from {path}")
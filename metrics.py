@@ -0,0 +1,209 @@
+# metrics.py
+import json
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Upper bounds of the latency buckets in seconds; one more bucket holds everything slower
+BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+)
+
+# Stages of handling a source event, in the order they happen
+STAGES = ('receive', 'filter', 'replace', 'download', 'upload', 'send', 'edit', 'delete', 'persist')
+
+
+class Histogram:
+    """Durations counted in fixed buckets, so its size never grows"""
+
+    __slots__ = ('counts', 'total')
+
+    def __init__(self, counts: Optional[List[int]] = None, total: float = 0.0):
+        self.counts = counts or [0] * (len(BUCKETS) + 1)
+        self.total = total
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the ``q`` quantile; infinite past the last bound"""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS + (float('inf'),), self.counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return 0.0
+
+    def merge(self, other: 'Histogram'):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.total += other.total
+
+
+class StageMetrics:
+    """Latency histograms per forwarding rule and stage.
+
+    Rules are keyed by ``(source_id, dest_id)``. Observing is a bisect and
+    two additions, cheap enough to stay on for every event.
+    """
+
+    def __init__(self):
+        self.histograms: Dict[Tuple[int, int], Dict[str, Histogram]] = {}
+
+    def observe(self, rule: Tuple[int, int], stage: str, seconds: float):
+        stages = self.histograms.get(rule)
+        if stages is None:
+            stages = self.histograms[rule] = {}
+        histogram = stages.get(stage)
+        if histogram is None:
+            histogram = stages[stage] = Histogram()
+        histogram.observe(seconds)
+
+    def snapshot(self) -> dict:
+        """The histograms in a JSON-friendly form, keyed by ``source:dest``"""
+        return {
+            f"{source_id}:{dest_id}": {
+                stage: {'counts': histogram.counts, 'sum': histogram.total}
+                for stage, histogram in stages.items()
+            }
+            for (source_id, dest_id), stages in self.histograms.items()
+        }
+
+
+class RuleCounters:
+    """Running totals per forwarding rule, e.g. of received or blocked messages"""
+
+    def __init__(self):
+        self.counts: Dict[str, Dict[Tuple[int, int], int]] = {}
+
+    def add(self, name: str, rule: Tuple[int, int], amount: int = 1):
+        counts = self.counts.get(name)
+        if counts is None:
+            counts = self.counts[name] = {}
+        counts[rule] = counts.get(rule, 0) + amount
+
+    def samples(self, name: str) -> List[list]:
+        return [
+            [{'rule': f"{source_id}:{dest_id}"}, count]
+            for (source_id, dest_id), count in self.counts.get(name, {}).items()
+        ]
+
+
+def load_snapshot(snapshot: dict) -> Dict[str, Dict[str, Histogram]]:
+    return {
+        rule: {stage: Histogram(list(data['counts']), data['sum']) for stage, data in stages.items()}
+        for rule, stages in snapshot.items()
+    }
+
+
+def merge_snapshots(snapshots: Iterable[dict]) -> dict:
+    """Add up the snapshots of several processes"""
+    merged: Dict[str, Dict[str, Histogram]] = {}
+    for snapshot in snapshots:
+        for rule, stages in load_snapshot(snapshot).items():
+            target = merged.setdefault(rule, {})
+            for stage, histogram in stages.items():
+                if stage in target:
+                    target[stage].merge(histogram)
+                else:
+                    target[stage] = histogram
+    return {
+        rule: {stage: {'counts': histogram.counts, 'sum': histogram.total} for stage, histogram in stages.items()}
+        for rule, stages in merged.items()
+    }
+
+
+def format_seconds(seconds: float) -> str:
+    if seconds == float('inf'):
+        return f">{BUCKETS[-1]:g}s"
+    if seconds < 0.001:
+        return f"{seconds * 1000000:g}µs"
+    if seconds < 1:
+        return f"{seconds * 1000:g}ms"
+    return f"{seconds:g}s"
+
+
+def format_stats(snapshot: dict) -> str:
+    """A readable summary of a snapshot: count, mean, p50 and p99 per rule and stage"""
+    if not snapshot:
+        return "No messages handled yet."
+    lines = []
+    for rule, stages in sorted(load_snapshot(snapshot).items()):
+        lines.append(f"**{rule}**")
+        for stage in sorted(stages, key=lambda name: STAGES.index(name) if name in STAGES else len(STAGES)):
+            histogram = stages[stage]
+            count = histogram.count
+            mean = histogram.total / count if count else 0.0
+            lines.append(
+                f"`{stage:<8}` n={count} avg={mean * 1000:.2f}ms "
+                f"p50≤{format_seconds(histogram.quantile(0.5))} p99≤{format_seconds(histogram.quantile(0.99))}"
+            )
+        lines.append("")
+    return '\n'.join(lines)
+
+
+# Prometheus export. Every process describes its metrics as families,
+# ``{name: {'type', 'help', 'samples': [[labels, value], ...]}}``, where a
+# histogram's value is ``{'counts', 'sum'}``. Families of several processes
+# are added up before they are rendered.
+
+def histogram_value(histogram: Histogram) -> dict:
+    return {'counts': histogram.counts, 'sum': histogram.total}
+
+
+def merge_families(processes: Iterable[dict]) -> dict:
+    merged: Dict[str, dict] = {}
+    for families in processes:
+        for name, family in families.items():
+            target = merged.setdefault(name, {'type': family['type'], 'help': family['help'], 'samples': {}})
+            for labels, value in family['samples']:
+                key = json.dumps(labels, sort_keys=True)
+                if key not in target['samples']:
+                    target['samples'][key] = [labels, value]
+                elif family['type'] == 'histogram':
+                    current = target['samples'][key][1]
+                    target['samples'][key][1] = {
+                        'counts': [a + b for a, b in zip(current['counts'], value['counts'])],
+                        'sum': current['sum'] + value['sum']
+                    }
+                else:
+                    target['samples'][key][1] += value
+    for family in merged.values():
+        family['samples'] = list(family['samples'].values())
+    return merged
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels: dict, **extra) -> str:
+    labels = {**labels, **extra}
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+def render_prometheus(families: dict) -> str:
+    """Families in the Prometheus text exposition format"""
+    lines = []
+    for name, family in families.items():
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['type']}")
+        for labels, value in family['samples']:
+            if family['type'] != 'histogram':
+                lines.append(f"{name}{_labels(labels)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS + (float('inf'),), value['counts']):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else f"{bound:g}"
+                lines.append(f"{name}_bucket{_labels(labels, le=le)} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {value['sum']}")
+            lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+    return '\n'.join(lines) + '\n'
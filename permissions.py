@@ -0,0 +1,60 @@
+# permissions.py
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, Tuple
+
+from telethon import utils
+from telethon.tl.types import (
+    PeerChannel, PeerChat, User,
+    UpdateChannel, UpdateChannelParticipant, UpdateChatParticipantAdmin
+)
+
+# Updates after which our membership or admin rights in a chat may be different
+RIGHTS_UPDATES = (UpdateChannel, UpdateChannelParticipant, UpdateChatParticipantAdmin)
+
+
+def rights_update_chat_id(update) -> int:
+    if isinstance(update, (UpdateChannel, UpdateChannelParticipant)):
+        return utils.get_peer_id(PeerChannel(update.channel_id))
+    return utils.get_peer_id(PeerChat(update.chat_id))
+
+
+async def _call(func, *args):
+    return await func(*args)
+
+
+class PermissionCache:
+    """Whether messages may be deleted in each destination chat, cached for ``ttl`` seconds.
+
+    Private chats always allow it; elsewhere we need to be an admin. Lookups
+    for the same chat that overlap share one pair of requests, and entries are
+    dropped early when an update says membership or rights changed.
+    """
+
+    def __init__(self, ttl: float = 600.0):
+        self.ttl = ttl
+        self._entries: Dict[int, Tuple[float, bool]] = {}
+        self._lookups: Dict[int, asyncio.Future] = {}
+
+    async def can_delete(self, client, chat_id: int, call: Callable[..., Awaitable] = _call) -> bool:
+        """Whether we may delete messages in the chat; lookups are made through ``call``"""
+        entry = self._entries.get(chat_id)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+
+        lookup = self._lookups.get(chat_id)
+        if lookup is None:
+            lookup = self._lookups[chat_id] = asyncio.ensure_future(self._lookup(client, chat_id, call))
+        return await asyncio.shield(lookup)
+
+    async def _lookup(self, client, chat_id: int, call: Callable[..., Awaitable]) -> bool:
+        try:
+            chat = await call(client.get_entity, chat_id)
+            allowed = isinstance(chat, User) or (await call(client.get_permissions, chat_id)).is_admin
+            self._entries[chat_id] = (time.monotonic() + self.ttl, allowed)
+            return allowed
+        finally:
+            self._lookups.pop(chat_id, None)
+
+    def invalidate(self, chat_id: int):
+        self._entries.pop(chat_id, None)
@@ -0,0 +1,81 @@
+# rules.py
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from dispatcher import BULK, FAST, LANES
+from text_rules import WordMatcher, WordReplacer
+
+
+class DestinationRule(NamedTuple):
+    """How messages from a source chat are sent to one destination"""
+    dest_id: int
+    forward_media: bool
+    native: bool
+    lane: Optional[str]  # Lane for all of the rule's sends; None picks one by content
+    replacer: WordReplacer
+    matcher: WordMatcher
+
+    def send_lane(self, media: bool) -> str:
+        """The rule's own lane, else bulk for media the rule forwards and fast for everything else"""
+        return self.lane or (BULK if media and self.forward_media else FAST)
+
+
+class RuleIndex:
+    """The forwarding rules compiled into a table keyed by source chat id.
+
+    An index is never changed once built. Config changes build a new index
+    and swap it in, so every event is handled with one consistent set of
+    rules even if the config changes while it is in flight. The word filters
+    and replacements are compiled once and shared by all rules of an index.
+    They are taken over from the ``previous`` index when their lists have not
+    changed, so adding or removing a rule does not recompile them.
+    """
+
+    def __init__(self, config: dict, previous: Optional['RuleIndex'] = None):
+        # Copies, so a later change to the config is seen as a change
+        self._replacements = dict(config['word_replacements'])
+        self._word_lists = (
+            list(config['blacklist_words']),
+            list(config['approved_words']),
+            config.get('match_whole_words', False)
+        )
+        if previous is not None and previous._replacements == self._replacements:
+            self.replacer = previous.replacer
+        else:
+            self.replacer = WordReplacer(self._replacements)
+        if previous is not None and previous._word_lists == self._word_lists:
+            self.matcher = previous.matcher
+        else:
+            blacklist, approved, whole_words = self._word_lists
+            self.matcher = WordMatcher(blacklist, approved, whole_words=whole_words)
+
+        media_settings = config['forward_media_settings']
+        mode_settings = config['forward_mode_settings']
+        # Unknown lane names are ignored rather than failing every send of the rule
+        lanes = {key: lane for key, lane in config['forward_priority_settings'].items() if lane in LANES}
+        self.routes: Dict[int, Tuple[DestinationRule, ...]] = {}
+        for source_id, dest_ids in config['forwarding_rules'].items():
+            if not dest_ids:
+                continue
+            self.routes[int(source_id)] = tuple(
+                DestinationRule(
+                    int(dest_id),
+                    media_settings.get(f"{source_id}:{dest_id}", True),
+                    mode_settings.get(f"{source_id}:{dest_id}") == 'native',
+                    lanes.get(f"{source_id}:{dest_id}"),
+                    self.replacer,
+                    self.matcher
+                )
+                for dest_id in dest_ids
+            )
+
+        # A media message waits in the fast inbound lane if any destination gets it through the fast lane
+        self.media_lanes: Dict[int, str] = {
+            source_id: FAST if any(rule.send_lane(True) == FAST for rule in rules) else BULK
+            for source_id, rules in self.routes.items()
+        }
+
+    def destinations(self, chat_id: int) -> Tuple[DestinationRule, ...]:
+        return self.routes.get(chat_id, ())
+
+    def media_lane(self, chat_id: int) -> str:
+        return self.media_lanes.get(chat_id, BULK)
@@ -0,0 +1,93 @@
+# text_rules.py
+import re
+from typing import Dict, Iterable, List
+
+
+class WordReplacer:
+    """Word replacement table compiled into a single regex.
+
+    Alternatives are sorted longest-first, so at any position the longest
+    matching phrase wins ("Professor Raees" before "Professor") and the text
+    is rewritten in one left-to-right pass regardless of the table's order.
+    """
+
+    def __init__(self, replacements: Dict[str, str]):
+        self.replacements = {old: new for old, new in replacements.items() if old}
+        if self.replacements:
+            alternatives = sorted(self.replacements, key=len, reverse=True)
+            self.pattern = re.compile('|'.join(re.escape(old) for old in alternatives))
+        else:
+            self.pattern = None
+
+    def _substitute(self, match: re.Match) -> str:
+        return self.replacements[match.group(0)]
+
+    def apply(self, text: str) -> str:
+        if not text or self.pattern is None:
+            return text
+        return self.pattern.sub(self._substitute, text)
+
+
+class WordMatcher:
+    """Blacklist and approved-word lists compiled for a single scan of the message.
+
+    Words are casefolded and deduplicated once when the matcher is built. The
+    message is scanned left to right with blacklist words tried before approved
+    words at every position; once an approved word has been seen, only the
+    blacklist is searched for in the rest of the text.
+    """
+
+    ALLOWED = 'allowed'
+    BLOCKED = 'blocked'
+    NOT_APPROVED = 'not_approved'
+
+    def __init__(self, blacklist: Iterable[str], approved: Iterable[str], whole_words: bool = False):
+        self.whole_words = whole_words
+        self.blacklist = self._normalise(blacklist)
+        self.approved = self._normalise(approved)
+
+        blocked = self._alternation(self.blacklist)
+        self.blacklist_pattern = re.compile(blocked) if self.blacklist else None
+        if self.blacklist and self.approved:
+            self.pattern = re.compile(f"(?P<blocked>{blocked})|{self._alternation(self.approved)}")
+        elif self.approved:
+            self.pattern = re.compile(self._alternation(self.approved))
+        else:
+            self.pattern = self.blacklist_pattern
+
+    @staticmethod
+    def _normalise(words: Iterable[str]) -> List[str]:
+        folded = {word.strip().casefold() for word in words if word and word.strip()}
+        return sorted(folded, key=len, reverse=True)
+
+    def _alternation(self, words: List[str]) -> str:
+        if not self.whole_words:
+            return '|'.join(re.escape(word) for word in words)
+
+        # Only anchor edges that are word characters, so entries such as URLs or
+        # emoji still match next to punctuation
+        alternatives = []
+        for word in words:
+            prefix = r'(?<!\w)' if re.match(r'\w', word[0]) else ''
+            suffix = r'(?!\w)' if re.match(r'\w', word[-1]) else ''
+            alternatives.append(f"{prefix}{re.escape(word)}{suffix}")
+        return '|'.join(alternatives)
+
+    def check(self, text: str) -> str:
+        if self.pattern is None:
+            return self.ALLOWED
+
+        folded = text.casefold()
+        match = self.pattern.search(folded)
+        if match is None:
+            return self.NOT_APPROVED if self.approved else self.ALLOWED
+        if not self.approved or match.lastgroup == 'blocked':
+            return self.BLOCKED
+        if self.blacklist_pattern is None:
+            return self.ALLOWED
+
+        # An approved word starts here and no blacklist word starts at or before
+        # it, so only the remainder needs checking against the blacklist
+        if self.blacklist_pattern.search(folded, match.start() + 1):
+            return self.BLOCKED
+        return self.ALLOWED
@@ -0,0 +1,159 @@
+# workers.py
+import asyncio
+import base64
+import itertools
+import logging
+import sys
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+from telethon.extensions import BinaryReader
+from telethon.sessions import SQLiteSession, StringSession
+
+from ipc import read_frame, write_frame
+
+logger = logging.getLogger(__name__)
+
+
+def encode_message(message) -> str:
+    """Serialize a message in Telegram's own binary format for another process"""
+    return base64.b64encode(bytes(message)).decode('ascii')
+
+
+def decode_message(data: str, client):
+    message = BinaryReader(base64.b64decode(data)).tgread_object()
+    message._finish_init(client, {}, None)
+    return message
+
+
+def session_string(name: str) -> str:
+    """Copy a login out of its session file so several processes can use it at once"""
+    session = SQLiteSession(name)
+    try:
+        return StringSession.save(session)
+    finally:
+        session.close()
+
+
+class _Worker:
+    __slots__ = ('index', 'port', 'process', 'writer', 'backlog')
+
+    def __init__(self, index: int, port: int):
+        self.index = index
+        self.port = port
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.backlog: Deque[dict] = deque()
+
+
+class WorkerPool:
+    """Worker processes that each forward the messages of a share of the source chats.
+
+    Sources are assigned to workers by chat id, so every message, edit and
+    delete of a source is handled by the same worker, in the order the
+    supervisor received them. Jobs for a worker that is (re)starting are held
+    back, up to ``max_backlog`` per worker, and sent once it is reachable.
+    A worker that exits is restarted after ``restart_delay`` seconds and is
+    sent the last published config before anything else.
+    """
+
+    def __init__(self, count: int, base_port: int, script: str,
+                 restart_delay: float = 5.0, max_backlog: int = 10000):
+        self.script = script
+        self.restart_delay = restart_delay
+        self.max_backlog = max_backlog
+        self.workers = [_Worker(index, base_port + index) for index in range(count)]
+        self._requests = itertools.count(1)
+        self._replies: Dict[int, asyncio.Future] = {}
+        self._published: Optional[dict] = None
+        self._stopping = False
+
+    def worker_for(self, source_id) -> _Worker:
+        return self.workers[abs(int(source_id)) % len(self.workers)]
+
+    async def start(self):
+        for worker in self.workers:
+            asyncio.create_task(self._supervise(worker))
+
+    async def _supervise(self, worker: _Worker):
+        while not self._stopping:
+            worker.process = await asyncio.create_subprocess_exec(
+                sys.executable, self.script, '--worker', str(worker.index)
+            )
+            logger.info(f"Started worker {worker.index} (pid {worker.process.pid})")
+            connection = asyncio.create_task(self._connect(worker))
+            code = await worker.process.wait()
+            connection.cancel()
+            if worker.writer is not None:
+                worker.writer.close()
+                worker.writer = None
+            if self._stopping:
+                break
+            logger.error(f"Worker {worker.index} exited with code {code}, restarting in {self.restart_delay}s")
+            await asyncio.sleep(self.restart_delay)
+
+    async def _connect(self, worker: _Worker):
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection('localhost', worker.port)
+                break
+            except OSError:
+                await asyncio.sleep(0.5)
+
+        worker.writer = writer
+        if self._published is not None:
+            write_frame(writer, self._published)
+        while worker.backlog:
+            write_frame(writer, worker.backlog.popleft())
+        logger.info(f"Connected to worker {worker.index} on port {worker.port}")
+
+        while True:
+            frame = await read_frame(reader)
+            if frame is None:
+                break
+            future = self._replies.pop(frame.get('id'), None)
+            if future is not None and not future.done():
+                future.set_result(frame.get('response', ''))
+
+    def _send(self, worker: _Worker, job: dict):
+        if worker.writer is None or worker.writer.is_closing():
+            if len(worker.backlog) >= self.max_backlog:
+                logger.warning(f"Worker {worker.index} backlog is full, dropping oldest job")
+                worker.backlog.popleft()
+            worker.backlog.append(job)
+            return
+        write_frame(worker.writer, job)
+
+    def submit(self, source_id, job: dict):
+        """Queue a job with the worker that owns the source, preserving submission order"""
+        self._send(self.worker_for(source_id), job)
+
+    def publish(self, job: dict):
+        """Send a job to every connected worker and to workers that connect later"""
+        self._published = job
+        for worker in self.workers:
+            if worker.writer is not None and not worker.writer.is_closing():
+                write_frame(worker.writer, job)
+
+    async def request(self, worker: _Worker, command: str, timeout: float = 30.0) -> str:
+        request_id = next(self._requests)
+        future = self._replies[request_id] = asyncio.get_running_loop().create_future()
+        self._send(worker, {'type': 'command', 'id': request_id, 'command': command})
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return f"Error: worker {worker.index} did not respond"
+        finally:
+            self._replies.pop(request_id, None)
+
+    async def broadcast(self, command: str) -> List[str]:
+        return await asyncio.gather(*(self.request(worker, command) for worker in self.workers))
+
+    async def stop(self):
+        self._stopping = True
+        for worker in self.workers:
+            if worker.process is not None and worker.process.returncode is None:
+                worker.process.terminate()
+        await asyncio.gather(*(
+            worker.process.wait() for worker in self.workers if worker.process is not None
+        ))